@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+'''Stand-in for the terraform executable used by the benchmarks.
+
+'output -json' prints the root module outputs of the state file given by
+-state=PATH, every other command succeeds without doing anything. The
+start up cost of terraform is simulated by sleeping
+$FAKE_TERRAFORM_LATENCY seconds.
+'''
+import json
+import os
+import sys
+import time
+
+
+def state_path(args):
+    for arg in args:
+        if arg.startswith('-state='):
+            return arg.split('=', 1)[1]
+    return 'terraform.tfstate'
+
+
+def outputs(path):
+    with open(path, 'r') as stream:
+        state = json.load(stream)
+    if 'modules' in state:
+        for module in state['modules']:
+            if module['path'] == ['root']:
+                return module['outputs']
+        return {}
+    return state.get('outputs', {})
+
+
+def main(args):
+    time.sleep(float(os.environ.get('FAKE_TERRAFORM_LATENCY', '0')))
+
+    if args[:2] == ['output', '-json']:
+        sys.stdout.write(json.dumps(outputs(state_path(args))))
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+'''Scaling benchmarks of the terraform infra provider.
+
+Every scenario generates a synthetic cluster of the given size in a
+temporary working directory and runs one operation of
+TerraformInfraProvider on it in a fresh python process. terraform is
+replaced by fake_terraform.py and the EC2 and AutoScaling APIs are
+answered by botocore before-call handlers, which sleep --latency seconds
+per call.
+
+    python benchmarks/run.py [--sizes=10,100,1000,10000]
+        [--clouds=aws,digitalocean]
+        [--operations=output,output_write,inventory,terraform_configure]
+        [--latency=0.005] [--terraform-latency=0] [--concurrency=1]
+        [--backend=terraform] [--inventory=compact|dict] [--repeat=1]
+        [--output=PATH]
+    python benchmarks/run.py compare OLD.json NEW.json
+
+Results are written as JSON, by default to
+benchmarks/results/<commit>.json.
+'''
+import collections
+import json
+import os
+import platform
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+defaults = collections.OrderedDict([
+    ('sizes', '10,100,1000,10000'),
+    ('clouds', 'aws,digitalocean'),
+    ('operations', 'output,output_write,inventory,terraform_configure'),
+    ('latency', '0.005'),
+    ('terraform-latency', '0'),
+    ('concurrency', '1'),
+    ('backend', 'terraform'),
+    ('inventory', 'compact'),
+    ('repeat', '1'),
+    ('output', None),
+])
+
+zones = ['eu-west-1a', 'eu-west-1b', 'eu-west-1c']
+
+StubResponse = collections.namedtuple('StubResponse', ['status_code'])
+
+
+def parse_options(args):
+    options = dict(defaults)
+    for arg in args:
+        name, sep, value = arg[2:].partition('=')
+        if not arg.startswith('--') or name not in defaults:
+            print("Unknown argument '%s'" % arg)
+            sys.exit(1)
+        options[name] = value if sep else True
+    return options
+
+
+def ip(network, index):
+    return '%d.%d.%d.%d' % (
+        network,
+        (index >> 16) & 255,
+        (index >> 8) & 255,
+        index & 255,
+    )
+
+
+class Cluster(object):
+    '''A synthetic cluster of size machines, 3 of them masters.'''
+
+    def __init__(self, cloud, size):
+        self.cloud = cloud
+        self.size = size
+        masters = min(3, size)
+        self.machines = collections.OrderedDict([
+            ('master', ['%s-master-%d' % (cloud, i) for i in range(masters)]),
+            ('worker', [
+                '%s-worker-%d' % (cloud, i) for i in range(size - masters)
+            ]),
+        ])
+        self.addresses = {}
+        for index, name in enumerate(
+            [name for names in self.machines.values() for name in names] +
+            ['bastion']
+        ):
+            self.addresses[name] = (ip(10, index), ip(100, index))
+
+    def parameters(self):
+        if self.cloud == 'aws':
+            instance_type = 'm3.medium'
+            custom = {
+                'aws_access_key': 'AKIABENCHMARK',
+                'aws_secret_key': 'benchmark',
+                'aws_region': 'eu-west-1',
+            }
+        else:
+            instance_type = '1gb'
+            custom = {
+                'digitalocean_token': 'benchmark',
+            }
+
+        return {
+            'general': {
+                'authentication': {
+                    'ssh': {
+                        'user': 'root',
+                        'privateKey': 'SECRET',
+                        'pubKey': 'ssh-rsa AAAA',
+                    },
+                },
+                'cluster': {
+                    'name': 'benchmark-%d' % self.size,
+                    'kubernetes': {
+                        'masterApiPort': 443,
+                        'version': '1.3.4',
+                        'serviceNetwork': '10.245.0.0/16',
+                    },
+                    'machines': dict([
+                        (mtype, {
+                            'count': len(names),
+                            'cores': 2,
+                            'memory': 1024,
+                            'instanceType': instance_type,
+                            'roles': [mtype],
+                        })
+                        for mtype, names in self.machines.items()
+                    ]),
+                },
+            },
+            'custom': custom,
+            'inventory': [],
+        }
+
+    def outputs(self):
+        if self.cloud == 'aws':
+            values = {
+                'master_asg': 'benchmark-master',
+                'worker_asg': 'benchmark-worker',
+                'bastion_instance_id': 'bastion',
+                'bastion_instance_eip': self.addresses['bastion'][1],
+                'bastion_instance_ip': self.addresses['bastion'][0],
+                'master_elb_dns_name': 'master.elb.example.com',
+            }
+        else:
+            values = {
+                'master_floating_ip':
+                self.addresses[self.machines['master'][0]][1],
+            }
+            for mtype, names in self.machines.items():
+                values['%s_hostnames' % mtype] = ','.join(names)
+                values['%s_private_ips' % mtype] = ','.join([
+                    self.addresses[name][0] for name in names
+                ])
+                values['%s_public_ips' % mtype] = ','.join([
+                    self.addresses[name][1] for name in names
+                ])
+
+        return dict([
+            (key, {'sensitive': False, 'type': 'string', 'value': value})
+            for key, value in values.items()
+        ])
+
+    def write(self, workdir):
+        import yaml
+
+        with open(os.path.join(workdir, 'parameters.yaml'), 'w') as stream:
+            yaml.safe_dump(
+                self.parameters(),
+                stream,
+                default_flow_style=False,
+            )
+
+        os.makedirs(os.path.join(workdir, 'terraform', self.cloud))
+        # terraform writes the version first, the state reader relies on it
+        state = collections.OrderedDict([
+            ('version', 3),
+            ('serial', 1),
+            ('modules', [collections.OrderedDict([
+                ('path', ['root']),
+                ('outputs', self.outputs()),
+                ('resources', {}),
+            ])]),
+        ])
+        path = os.path.join(workdir, 'terraform', 'terraform.tfstate')
+        with open(path, 'w') as stream:
+            json.dump(state, stream, indent=2)
+
+
+class AWSStub(object):
+    '''Answers the EC2 and AutoScaling calls of the AWS plugin from a
+    Cluster, without any network access.
+    '''
+
+    def __init__(self, cluster, latency):
+        self.cluster = cluster
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.groups = {
+            'benchmark-master': cluster.machines['master'],
+            'benchmark-worker': cluster.machines['worker'],
+        }
+
+    def install(self, plugin):
+        plugin.client_ec2.meta.events.register(
+            'before-call.ec2',
+            self.handle,
+        )
+        plugin.client_autscaling.meta.events.register(
+            'before-call.autoscaling',
+            self.handle,
+        )
+
+    def handle(self, model, params, **kwargs):
+        self.calls[model.name] += 1
+        time.sleep(self.latency)
+        return StubResponse(200), getattr(self, model.name)(params['body'])
+
+    def values(self, body, prefix):
+        return [
+            value for key, value in body.items()
+            if key.startswith(prefix)
+        ]
+
+    def DescribeAvailabilityZones(self, body):
+        return {
+            'AvailabilityZones': [
+                {'ZoneName': zone, 'State': 'available'} for zone in zones
+            ],
+        }
+
+    def DescribeAutoScalingGroups(self, body):
+        return {
+            'AutoScalingGroups': [
+                {
+                    'AutoScalingGroupName': name,
+                    'Instances': [
+                        {'InstanceId': instance_id}
+                        for instance_id in self.groups[name]
+                    ],
+                }
+                for name in self.values(body, 'AutoScalingGroupNames.member.')
+            ],
+        }
+
+    def DescribeInstances(self, body):
+        return {
+            'Reservations': [{
+                'Instances': [
+                    {
+                        'InstanceId': instance_id,
+                        'PrivateIpAddress':
+                        self.cluster.addresses[instance_id][0],
+                        'PublicIpAddress':
+                        self.cluster.addresses[instance_id][1],
+                    }
+                    for instance_id in self.values(body, 'InstanceId.')
+                ],
+            }],
+        }
+
+
+operations = {
+    'output': lambda provider: provider.output(),
+    'output_write': lambda provider: provider.output_write(),
+    # the entries as built, inventory() converts them to dicts
+    'inventory': lambda provider: list(provider.cloud.iter_inventory()),
+    'terraform_configure': lambda provider: provider.terraform_configure(),
+}
+
+
+def deep_size(obj, seen=None):
+    '''Approximate size in bytes of obj and everything it references,
+    objects shared between entries are counted once.
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            size += deep_size(value, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += deep_size(getattr(obj, name, None), seen)
+    return size
+
+
+def max_rss():
+    '''Peak resident set size of this process in KiB.'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+
+def scenario(cloud, size, operation, result_path, options):
+    '''Run a single scenario in this process and write its measurements
+    to result_path.
+    '''
+    sys.path.insert(0, root)
+    from slingpy import TerraformInfraProvider
+
+    cluster = Cluster(cloud, size)
+    workdir = tempfile.mkdtemp(prefix='slingpy-benchmark-')
+    try:
+        cluster.write(workdir)
+
+        provider = TerraformInfraProvider(workdir=workdir)
+        provider.concurrency = int(options['concurrency'])
+        provider.terraform_output_backend = options['backend']
+        # keep the host's caches out of the results
+        provider.terraform_plugin_cache_dir = os.path.join(
+            workdir,
+            'plugin-cache',
+        )
+        provider.cloud.metadata_cache_mode = 'off'
+        stub = None
+        if cloud == 'aws':
+            stub = AWSStub(cluster, float(options['latency']))
+            stub.install(provider.cloud)
+        provider.cloud.inventory_compact = options['inventory'] == 'compact'
+
+        baseline = max_rss()
+        started = time.time()
+        cpu_started = time.clock()
+        value = operations[operation](provider)
+        wall = time.time() - started
+        cpu = time.clock() - cpu_started
+
+        calls = dict(stub.calls) if stub is not None else {}
+        result = {
+            'cloud': cloud,
+            'size': size,
+            'operation': operation,
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'api_calls': calls,
+            'api_calls_total': sum(calls.values()),
+            'subprocesses': provider.terraform_processes,
+            'baseline_rss_kb': baseline,
+            'peak_rss_kb': max_rss(),
+            'result_bytes': deep_size(value) if value is not None else None,
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+    with open(result_path, 'w') as stream:
+        json.dump(result, stream)
+
+
+def fake_terraform_bin(tmpdir):
+    '''Return a directory with a terraform executable that runs
+    fake_terraform.py with this python.
+    '''
+    bin_dir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, 'terraform')
+    with open(path, 'w') as stream:
+        stream.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (
+            sys.executable,
+            os.path.join(root, 'benchmarks', 'fake_terraform.py'),
+        ))
+    os.chmod(path, stat.S_IRWXU)
+    return bin_dir
+
+
+def run_scenario(tmpdir, env, cloud, size, operation, options):
+    result_path = os.path.join(tmpdir, 'result.json')
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            'scenario',
+            cloud,
+            str(size),
+            operation,
+            result_path,
+        ] + ['--%s=%s' % (k, v) for k, v in options.items() if v is not None],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    _, err = process.communicate()
+    if process.returncode != 0:
+        sys.stderr.write(err[-4096:])
+        print("scenario %s %d %s failed with exit code %d" % (
+            cloud,
+            size,
+            operation,
+            process.returncode,
+        ))
+        sys.exit(1)
+
+    with open(result_path, 'r') as stream:
+        return json.load(stream)
+
+
+def git(*args):
+    try:
+        return subprocess.check_output(
+            ['git'] + list(args),
+            cwd=root,
+            stderr=open(os.devnull, 'w'),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    sizes = [int(size) for size in options['sizes'].split(',')]
+    clouds = options['clouds'].split(',')
+    names = options['operations'].split(',')
+    for name in names:
+        if name not in operations:
+            print("Unknown operation '%s'" % name)
+            sys.exit(1)
+
+    commit = git('rev-parse', 'HEAD')
+    document = {
+        'commit': commit,
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': dict(
+            (k, v) for k, v in options.items() if k != 'output'
+        ),
+        'results': [],
+    }
+
+    tmpdir = tempfile.mkdtemp(prefix='slingpy-benchmark-')
+    try:
+        env = dict(os.environ)
+        env['PATH'] = os.pathsep.join([
+            fake_terraform_bin(tmpdir),
+            env.get('PATH', ''),
+        ])
+        env['FAKE_TERRAFORM_LATENCY'] = options['terraform-latency']
+
+        scenario_options = dict(
+            (k, v) for k, v in options.items()
+            if k in ['latency', 'concurrency', 'backend', 'inventory']
+        )
+        for cloud in clouds:
+            for size in sizes:
+                for name in names:
+                    runs = [
+                        run_scenario(
+                            tmpdir,
+                            env,
+                            cloud,
+                            size,
+                            name,
+                            scenario_options,
+                        )
+                        for _ in range(int(options['repeat']))
+                    ]
+                    result = min(runs, key=lambda r: r['wall_seconds'])
+                    result['wall_seconds_all'] = [
+                        r['wall_seconds'] for r in runs
+                    ]
+                    document['results'].append(result)
+                    print(format_result(result))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    path = options['output']
+    if path is None:
+        path = os.path.join(
+            root,
+            'benchmarks',
+            'results',
+            '%s.json' % (commit or 'unknown')[:12],
+        )
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    with open(path, 'w') as stream:
+        json.dump(document, stream, indent=2, sort_keys=True)
+    print("wrote '%s'" % path)
+
+
+def format_result(result):
+    return '%-12s %6d %-20s %9.3fs %5d calls %3d processes %8d KiB' % (
+        result['cloud'],
+        result['size'],
+        result['operation'],
+        result['wall_seconds'],
+        result['api_calls_total'],
+        result['subprocesses'],
+        result['peak_rss_kb'],
+    )
+
+
+def compare(old_path, new_path):
+    '''Print the change of every scenario present in both result files.'''
+    documents = []
+    for path in [old_path, new_path]:
+        with open(path, 'r') as stream:
+            documents.append(json.load(stream))
+
+    old = dict(
+        ((r['cloud'], r['size'], r['operation']), r)
+        for r in documents[0]['results']
+    )
+    print('%s -> %s' % (
+        (documents[0]['commit'] or 'unknown')[:12],
+        (documents[1]['commit'] or 'unknown')[:12],
+    ))
+    for result in documents[1]['results']:
+        key = (result['cloud'], result['size'], result['operation'])
+        if key not in old:
+            continue
+        before = old[key]
+        print('%-12s %6d %-20s %9.3fs -> %9.3fs (%+6.1f%%) '
+              '%5d -> %5d calls %3d -> %3d processes '
+              '%8d -> %8d KiB' % (
+                  key + (
+                      before['wall_seconds'],
+                      result['wall_seconds'],
+                      100.0 * (
+                          result['wall_seconds'] - before['wall_seconds']
+                      ) / max(before['wall_seconds'], 1e-9),
+                      before['api_calls_total'],
+                      result['api_calls_total'],
+                      before['subprocesses'],
+                      result['subprocesses'],
+                      before['peak_rss_kb'],
+                      result['peak_rss_kb'],
+                  )
+              ))
+
+
+def main(argv):
+    if argv[1:2] == ['scenario']:
+        cloud, size, operation, result_path = argv[2:6]
+        scenario(
+            cloud,
+            int(size),
+            operation,
+            result_path,
+            parse_options(argv[6:]),
+        )
+    elif argv[1:2] == ['compare']:
+        if len(argv) != 4:
+            print("Please specify %s compare OLD.json NEW.json" % argv[0])
+            sys.exit(1)
+        compare(argv[2], argv[3])
+    else:
+        run(parse_options(argv[1:]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import sys
+import time
+
+
+def run_cluster(args):
+    '''Run command for the cluster in workdir. Executed in its own worker
+    process, all output goes to the cluster's slingpy.log.
+    '''
+    provider_class, command, workdir, options = args
+    result = {
+        'cluster': workdir,
+        'status': 'ok',
+    }
+    started = time.time()
+
+    log = None
+    try:
+        log = open(os.path.join(workdir, 'slingpy.log'), 'a')
+        sys.stdout = sys.stderr = log
+        provider = provider_class(workdir=workdir)
+        provider.command([provider_class.__name__, command] + options)
+    except SystemExit as e:
+        if e.code not in [None, 0]:
+            result['status'] = 'failed'
+            result['error'] = 'exit code %s' % e.code
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        if log is not None:
+            log.flush()
+
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+
+def run(provider_class, command, workdirs, processes=None, options=[]):
+    '''Run command with the '--' options for every cluster directory on a
+    pool of processes. Every cluster gets a fresh process, so no state is
+    shared between them. Returns one result dict per cluster, in the order
+    of workdirs.
+    '''
+    workdirs = [os.path.abspath(workdir) for workdir in workdirs]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(workdirs)))
+
+    pool = multiprocessing.Pool(processes=processes, maxtasksperchild=1)
+    try:
+        return pool.map(
+            run_cluster,
+            [
+                (provider_class, command, workdir, options)
+                for workdir in workdirs
+            ],
+            chunksize=1,
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+
+def summary(results, seconds):
+    failed = [r for r in results if r['status'] != 'ok']
+    lines = [
+        '%-6s %8.1fs  %s%s' % (
+            r['status'],
+            r['seconds'],
+            r['cluster'],
+            '  (%s)' % r['error'] if 'error' in r else '',
+        )
+        for r in results
+    ]
+    lines.append('%d clusters, %d failed, %.1fs' % (
+        len(results),
+        len(failed),
+        seconds,
+    ))
+    return '\n'.join(lines)
+
+
+def main(provider_class, argv):
+    '''Entry point for './provider batch <command> <dir>...
+    [--processes=N] [--option...]'. Options other than --processes are
+    passed to the command of every cluster.
+    '''
+    args = [arg for arg in argv[2:] if not arg.startswith('--')]
+    options = []
+    processes = None
+    for arg in argv[2:]:
+        if arg.startswith('--processes='):
+            processes = int(arg.split('=', 1)[1])
+        elif arg.startswith('--'):
+            options.append(arg)
+
+    if len(args) < 2:
+        print("Please specify ./%s batch <command> <cluster dir>... "
+              "[--processes=N] [--option...]" % argv[0])
+        sys.exit(1)
+
+    started = time.time()
+    results = run(provider_class, args[0], args[1:], processes, options)
+    print(summary(results, time.time() - started))
+
+    if any(r['status'] != 'ok' for r in results):
+        sys.exit(1)
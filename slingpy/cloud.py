@@ -1,6 +1,117 @@
+from tools import JSONDiskCache, plain
+from inventory import InventoryEntry
+import collections
+import hashlib
+import importlib
 import itertools
-import boto3
+import os
+import threading
+import time
 import sys
+import tracing
+
+
+# projection of the EC2 instance fields used for the inventory
+Instance = collections.namedtuple(
+    'Instance',
+    ['id', 'public_ip_address', 'private_ip_address'],
+)
+
+
+def _trace_before_call(model, context, **kwargs):
+    context['trace_start'] = time.time()
+
+
+def _trace_after_call(model, context, **kwargs):
+    name = 'aws %s' % model.name
+    tracing.count(name)
+    start = context.get('trace_start')
+    if start is not None:
+        tracing.add(name, start, time.time() - start)
+
+
+class AWSClientPool(object):
+    '''Builds boto3 sessions, clients and resources once per credentials
+    and region and shares them, including their connection pools, between
+    plugins and threads.
+    '''
+
+    def __init__(self, max_pool_connections=10):
+        self.max_pool_connections = max_pool_connections
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._objects = {}
+
+    def _config(self):
+        import botocore.config
+        try:
+            return botocore.config.Config(
+                max_pool_connections=self.max_pool_connections,
+            )
+        except TypeError:
+            # older botocore, the connection pool is resized on the client
+            return None
+
+    def _resize(self, client):
+        endpoint = getattr(client, '_endpoint', None)
+        if endpoint is None or not hasattr(endpoint, 'http_session'):
+            return
+        from botocore.vendored.requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(
+            pool_connections=self.max_pool_connections,
+            pool_maxsize=self.max_pool_connections,
+        )
+        endpoint.http_session.mount('https://', adapter)
+
+    def _session(self, credentials):
+        session = self._sessions.get(credentials)
+        if session is None:
+            # boto3 is slow to import, only load it once it is needed
+            import boto3
+            access_key, secret_key, region = credentials
+            session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                region_name=region,
+            )
+            self._sessions[credentials] = session
+        return session
+
+    def _get(self, kind, service, credentials):
+        key = (kind, service, credentials)
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                factory = getattr(self._session(credentials), kind)
+                config = self._config()
+                if config is not None:
+                    obj = factory(service, config=config)
+                elif kind == 'resource':
+                    obj = factory(service)
+                    self._resize(obj.meta.client)
+                else:
+                    obj = factory(service)
+                    self._resize(obj)
+                client = obj.meta.client if kind == 'resource' else obj
+                client.meta.events.register('before-call', _trace_before_call)
+                client.meta.events.register('after-call', _trace_after_call)
+                self._objects[key] = obj
+            return obj
+
+    def session(self, credentials):
+        with self._lock:
+            return self._session(credentials)
+
+    def client(self, service, credentials):
+        return self._get('client', service, credentials)
+
+    def resource(self, service, credentials):
+        return self._get('resource', service, credentials)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._objects.clear()
 
 
 class Plugin(object):
@@ -10,6 +121,19 @@ class Plugin(object):
     regions = []
     region_default = None
     required_params = []
+    # seconds cloud metadata, like the available zones, is cached on disk
+    metadata_cache_ttl = 24 * 3600
+    # 'online' refreshes expired entries, 'stale-ok' falls back to expired
+    # entries if the refresh fails, 'offline' only reads the cache and
+    # 'off' disables it; also set by --metadata-cache=MODE, --offline
+    # implies 'offline'
+    metadata_cache_mode = 'online'
+    # shared by all clusters of the host, defaults to
+    # $XDG_CACHE_HOME/slingpy or ~/.cache/slingpy
+    metadata_cache_dir = None
+    # yield InventoryEntry instead of dicts from iter_inventory(), which
+    # output_write() streams; inventory() always returns dicts
+    inventory_compact = True
 
     def __init__(self, provider):
         self._provider = provider
@@ -17,13 +141,6 @@ class Plugin(object):
     def validate(self):
         pass
 
-    def detect(self):
-        keys = self._provider.parameters["custom"].keys()
-        for key in self.required_params:
-            if self.key(key) not in keys:
-                return False
-        return True
-
     def region(self):
         try:
             r = self.param('region').lower()
@@ -50,6 +167,17 @@ class Plugin(object):
         tf = self._provider.terraform_output()
         return tf[key]['value']
 
+    def terraform_output_list(self, key):
+        '''Return an output as list, it can either be a native terraform
+        list or a comma joined string.
+        '''
+        value = self.terraform_output(key)
+        if isinstance(value, list):
+            return value
+        if value == '':
+            return []
+        return value.split(',')
+
     def variables(self):
         output = {}
 
@@ -61,23 +189,133 @@ class Plugin(object):
     def zones(self):
         try:
             z = self.param('zones').split(',')
-            z_available = self.zones_available()
+        except KeyError:
+            z = None
+        z_available = self.zones_available()
+
+        if z is None:
+            if z_available is None and self.metadata_mode() == 'offline':
+                self._provider.log.fatal(
+                    "available zones are not cached, set the zones "
+                    "parameter or run once online"
+                )
+                sys.exit(1)
+            return z_available
 
-            if z_available is None:
-                return z
+        # explicit zones are only validated if the available ones are known
+        if z_available is None:
+            return z
 
-            for zone in z:
-                if zone not in z_available:
-                    self._provider.log.fatal("Wrong zone '%s'", zone)
-                    sys.exit(1)
+        for zone in z:
+            if zone not in z_available:
+                self._provider.log.fatal("Wrong zone '%s'", zone)
+                sys.exit(1)
 
-            return z
-        except KeyError:
-            return self.zones_available()
+        return z
 
     def zones_available(self):
         return None
 
+    def warm_up(self):
+        '''Create API clients ahead of their first use.'''
+        pass
+
+    def metadata_scope(self):
+        '''Return the strings identifying the account, region and endpoint
+        cached metadata belongs to.
+        '''
+        return [self.name]
+
+    def metadata_cache(self):
+        path = self.metadata_cache_dir
+        if path is None:
+            path = os.path.join(
+                os.environ.get(
+                    'XDG_CACHE_HOME',
+                    os.path.expanduser(os.path.join('~', '.cache')),
+                ),
+                'slingpy',
+            )
+        return JSONDiskCache(path)
+
+    def metadata_mode(self):
+        options = getattr(self._provider, 'options', {})
+        if options.get('offline') is True:
+            return 'offline'
+        return options.get('metadata-cache', self.metadata_cache_mode)
+
+    def metadata(self, name, func):
+        '''Return the metadata name, read from the disk cache or fetched
+        with func. Returns None in offline mode if nothing is cached.
+        '''
+        mode = self.metadata_mode()
+        if mode == 'off':
+            return func()
+
+        # only a digest of the scope, which may contain credentials, is
+        # written to disk
+        key = hashlib.sha1(
+            '\0'.join([name] + self.metadata_scope())
+        ).hexdigest()
+        cache = self.metadata_cache()
+
+        value = cache.get(
+            key,
+            max_age=None if mode == 'offline' else self.metadata_cache_ttl,
+        )
+        if value is not None:
+            self._provider.log.debug("metadata '%s' cache hit" % name)
+            return value
+        if mode == 'offline':
+            self._provider.log.warn(
+                "metadata '%s' is not cached, offline mode" % name
+            )
+            return None
+
+        try:
+            value = func()
+        except Exception as e:
+            stale = cache.get(key) if mode == 'stale-ok' else None
+            if stale is None:
+                raise
+            self._provider.log.warn(
+                "using stale metadata '%s': %s" % (name, e)
+            )
+            return stale
+
+        cache.set(key, value)
+        return value
+
+    def inventory_entry(self, name, roles, public_ip=None, private_ip=None):
+        if self.inventory_compact:
+            return InventoryEntry(name, roles, public_ip, private_ip)
+
+        entry = {
+            'name': name,
+            'roles': list(roles),
+        }
+        if public_ip is not None:
+            entry['publicIP'] = public_ip
+        if private_ip is not None:
+            entry['privateIP'] = private_ip
+        return entry
+
+    def iter_inventory(self):
+        return iter([])
+
+    def inventory(self):
+        '''Return the inventory as list of plain dicts.'''
+        return plain(self.iter_inventory())
+
+    def output_inventory(self):
+        '''Return the inventory for the output. This is an iterator, so
+        output_write() writes the entries as they are produced, unless a
+        subclass overrides inventory().
+        '''
+        if type(self).inventory.__func__ is Plugin.inventory.__func__:
+            return self.iter_inventory()
+        return self.inventory()
+
     def output(self, output):
         return output
 
@@ -160,47 +398,119 @@ class AWSPlugin(Plugin):
         'ap-south-1',
         'sa-east-1',
     ]
+    describe_instances_chunk_size = 100
+    # shared by all AWSPlugin instances, set an own pool to change the
+    # maximum number of connections per client
+    client_pool = AWSClientPool()
+
+    def credentials(self):
+        return (
+            self.param('access_key'),
+            self.param('secret_key'),
+            self.region(),
+        )
 
     @property
     def session(self):
-        return boto3.Session(
-            aws_access_key_id=self.param('access_key'),
-            aws_secret_access_key=self.param('secret_key'),
-            region_name=self.region(),
-        )
+        return self.client_pool.session(self.credentials())
 
     @property
     def ec2(self):
-        return self.session.resource('ec2')
+        return self.client_pool.resource('ec2', self.credentials())
 
     @property
     def iam(self):
-        return self.session.resource('iam')
+        return self.client_pool.resource('iam', self.credentials())
 
     @property
     def client_autscaling(self):
-        return self.session.client('autoscaling')
+        return self.client_pool.client('autoscaling', self.credentials())
 
     @property
     def client_ec2(self):
-        return self.session.client('ec2')
-
-    def autoscaling_instances(self, name):
-        result = self.client_autscaling.describe_auto_scaling_groups(
-            AutoScalingGroupNames=[
-                name,
-            ]
+        return self.client_pool.client('ec2', self.credentials())
+
+    def autoscaling_groups(self, names):
+        '''Return the instance ids of each named autoscaling group,
+        resolved with a single paginated API call.
+        '''
+        paginator = self.client_autscaling.get_paginator(
+            'describe_auto_scaling_groups'
         )
 
-        instances = []
+        groups = {}
+        with tracing.span('aws autoscaling groups'):
+            pages = list(paginator.paginate(AutoScalingGroupNames=names))
+        for page in pages:
+            for group in page['AutoScalingGroups']:
+                groups[group['AutoScalingGroupName']] = [
+                    instance['InstanceId'] for instance in group['Instances']
+                ]
+
+        for name in names:
+            if name not in groups:
+                self._provider.log.fatal(
+                    "Autoscaling group '%s' not found", name
+                )
+                sys.exit(1)
+
+        return [groups[name] for name in names]
+
+    def describe_instances(self, ids):
+        '''Yield an Instance for each id, in the order of ids. Instances
+        are described in chunks of describe_instances_chunk_size, which
+        run concurrently if the provider allows it.
+        '''
+        size = self.describe_instances_chunk_size
+        chunks = [
+            ids[offset:offset + size]
+            for offset in range(0, len(ids), size)
+        ]
+        for instances in self._provider.imap(self.describe_chunk, chunks):
+            for instance in instances:
+                yield instance
+
+    def describe_chunk(self, ids):
+        paginator = self.client_ec2.get_paginator('describe_instances')
+
+        instances = {}
+        with tracing.span('aws describe instances', instances=len(ids)):
+            pages = list(paginator.paginate(InstanceIds=ids))
+        for page in pages:
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = Instance(
+                        id=instance['InstanceId'],
+                        public_ip_address=instance.get('PublicIpAddress'),
+                        private_ip_address=instance.get('PrivateIpAddress'),
+                    )
+
+        return [instances[instance_id] for instance_id in ids]
 
-        for instance in result['AutoScalingGroups'][0]['Instances']:
-            instances.append(self.ec2.Instance(instance['InstanceId']))
+    def autoscaling_instances(self, name):
+        return list(self.describe_instances(
+            self.autoscaling_groups([name])[0]
+        ))
 
-        return instances
+    def metadata_scope(self):
+        access_key, _, region = self.credentials()
+        return [
+            self.name,
+            access_key,
+            region,
+            'ec2.%s.amazonaws.com' % region,
+        ]
 
     def zones_available(self):
-        zones = self.client_ec2.describe_availability_zones()
+        return self.metadata('zones', self.zones_describe)
+
+    def warm_up(self):
+        self.client_ec2
+        self.client_autscaling
+
+    def zones_describe(self):
+        with tracing.span('aws zones'):
+            zones = self.client_ec2.describe_availability_zones()
         return [
             zone['ZoneName']
             for zone in zones['AvailabilityZones']
@@ -225,7 +535,9 @@ class AWSPlugin(Plugin):
 
     @property
     def bastion_instance(self):
-        return self.ec2.Instance(self.terraform_output('bastion_instance_id'))
+        return next(self.describe_instances([
+            self.terraform_output('bastion_instance_id'),
+        ]))
 
     @property
     def master_instances(self):
@@ -233,38 +545,32 @@ class AWSPlugin(Plugin):
             self.terraform_output('master_asg')
         )
 
-    def inventory_for_instance(self, i):
-        inventory = {
-            'name': i.id,
-        }
-
-        if i.public_ip_address is not None:
-            inventory['publicIP'] = i.public_ip_address
-
-        if i.private_ip_address is not None:
-            inventory['privateIP'] = i.private_ip_address
-
-        return inventory
-
-    def inventory(self):
-        inventory = []
-        roles = ['master']
-        for instance in self.master_instances:
-            i = self.inventory_for_instance(instance)
-            i['roles'] = roles
-            inventory.append(i)
+    def inventory_for_instance(self, i, roles=()):
+        return self.inventory_entry(
+            i.id,
+            roles,
+            public_ip=i.public_ip_address,
+            private_ip=i.private_ip_address,
+        )
 
-        roles = ['worker']
-        for instance in self.worker_instances:
-            i = self.inventory_for_instance(instance)
-            i['roles'] = roles
-            inventory.append(i)
+    def iter_inventory(self):
+        master_ids, worker_ids = self.autoscaling_groups([
+            self.terraform_output('master_asg'),
+            self.terraform_output('worker_asg'),
+        ])
+        groups = [
+            (['master'], master_ids),
+            (['worker'], worker_ids),
+            (['bastion'], [self.terraform_output('bastion_instance_id')]),
+        ]
 
-        i = self.inventory_for_instance(self.bastion_instance)
-        i['roles'] = ['bastion']
-        inventory.append(i)
+        instances = self.describe_instances(
+            [instance_id for _, ids in groups for instance_id in ids]
+        )
 
-        return inventory
+        for roles, ids in groups:
+            for _ in ids:
+                yield self.inventory_for_instance(next(instances), roles)
 
     def flocker_enabled(self):
         try:
@@ -277,7 +583,7 @@ class AWSPlugin(Plugin):
             return False
 
     def output(self, output):
-        output['inventory'] = self.inventory()
+        output['inventory'] = self.output_inventory()
 
         # remove secrets aws
         output['custom']['aws_secret_key'] = '-removed-'
@@ -344,36 +650,51 @@ class DigitaloceanPlugin(Plugin):
         return output
 
     def machines_list(self, mtype):
-        for i in itertools.count():
-            output = {}
-            for name in ['hostnames', 'private_ips', 'public_ips']:
-                try:
-                    output[name[:-1]] = self.terraform_output(
-                        '%s_%s' % (mtype, name)
-                    ).split(',')[i]
-                except IndexError:
-                    break
-            else:
-                yield output
-                continue
-            break
+        names = ['hostnames', 'private_ips', 'public_ips']
+        columns = [
+            self.terraform_output_list('%s_%s' % (mtype, name))
+            for name in names
+        ]
 
-    def inventory(self):
-        inventory = []
-        for mtype, machine in self._provider\
-                .parameters['general']['cluster']['machines'].iteritems():
-            for data in self.machines_list(mtype):
-                inventory.append({
-                    'name': data['hostname'],
-                    'roles': machine['roles'],
-                    'publicIP': data['public_ip'],
-                    'privateIP': data['private_ip'],
-                })
-
-        return inventory
+        if len(set(len(column) for column in columns)) > 1:
+            self._provider.log.fatal(
+                "Mismatching outputs for machine type '%s': %s",
+                mtype,
+                ', '.join([
+                    '%s=%d' % (name, len(column))
+                    for name, column in zip(names, columns)
+                ]),
+            )
+            sys.exit(1)
+
+        keys = [name[:-1] for name in names]
+        for values in itertools.izip(*columns):
+            yield dict(itertools.izip(keys, values))
+
+    def inventory_for_machine_type(self, item):
+        mtype, machine = item
+        return [
+            self.inventory_entry(
+                data['hostname'],
+                machine['roles'],
+                public_ip=data['public_ip'],
+                private_ip=data['private_ip'],
+            )
+            for data in self.machines_list(mtype)
+        ]
+
+    def iter_inventory(self):
+        machines = self._provider\
+            .parameters['general']['cluster']['machines'].items()
+        for entries in self._provider.imap(
+            self.inventory_for_machine_type,
+            machines,
+        ):
+            for entry in entries:
+                yield entry
 
     def output(self, output):
-        output['inventory'] = self.inventory()
+        output['inventory'] = self.output_inventory()
 
         k8soutput = output['general']['cluster']['kubernetes']
 
@@ -384,6 +705,77 @@ class DigitaloceanPlugin(Plugin):
 
         k8soutput['masterSan'] = [
             master_ip,
-        ] + self.terraform_output('master_public_ips').split(',')
+        ] + self.terraform_output_list('master_public_ips')
 
         return output
+
+
+class PluginRegistry(object):
+    '''Cloud plugins by name. A plugin is declared with the import path of
+    its class and the custom parameter keys it requires, so it can be
+    detected without importing it. Plugins of other packages are
+    registered with the 'slingpy.clouds' entry point group and are only
+    looked up if no registered plugin matches.
+    '''
+    entry_point_group = 'slingpy.clouds'
+
+    def __init__(self):
+        self._plugins = collections.OrderedDict()
+        self._entry_points_loaded = False
+
+    def register(self, name, path, required_params):
+        '''Register the plugin class at path ('module:Class').'''
+        self._plugins[name] = (path, list(required_params))
+
+    def _load_entry_points(self):
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+        import pkg_resources
+        for entry_point in pkg_resources.iter_entry_points(
+            self.entry_point_group
+        ):
+            if entry_point.name in self._plugins:
+                continue
+            plugin = entry_point.load()
+            self.register(
+                entry_point.name,
+                '%s:%s' % (plugin.__module__, plugin.__name__),
+                plugin.required_params,
+            )
+
+    def _match(self, keys):
+        for name, (_, required_params) in self._plugins.iteritems():
+            if all(
+                '%s_%s' % (name, key) in keys for key in required_params
+            ):
+                return name
+        return None
+
+    def detect(self, keys):
+        '''Return the name of the first plugin whose required parameters
+        are all in keys, or None.
+        '''
+        name = self._match(keys)
+        if name is None:
+            self._load_entry_points()
+            name = self._match(keys)
+        return name
+
+    def load(self, name):
+        '''Import and return the plugin class registered as name.'''
+        module, attr = self._plugins[name][0].split(':')
+        return getattr(importlib.import_module(module), attr)
+
+
+plugins = PluginRegistry()
+plugins.register(
+    AWSPlugin.name,
+    'slingpy.cloud:AWSPlugin',
+    AWSPlugin.required_params,
+)
+plugins.register(
+    DigitaloceanPlugin.name,
+    'slingpy.cloud:DigitaloceanPlugin',
+    DigitaloceanPlugin.required_params,
+)
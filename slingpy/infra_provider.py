@@ -3,11 +3,12 @@ import os
 
 
 class InfraProvider(Provider):
+    provider_type = 'infra'
     parameters_file_path = os.path.abspath('parameters.yaml')
     output_file_path = os.path.abspath('output.yaml')
 
-    def __init__(self):
-        super(InfraProvider, self).__init__("infra")
+    def __init__(self, workdir=None):
+        super(InfraProvider, self).__init__("infra", workdir=workdir)
 
     def output(self):
         p = self.parameters
@@ -31,9 +32,23 @@ class InfraProvider(Provider):
 
         return p
 
+    def output_document(self):
+        '''Return the output for output_write(). Values may be iterators,
+        which are written as lists while they are consumed.
+        '''
+        return self.output()
+
     def output_write(self):
         path = self.output_file_path
-        content = self.yaml(self.output())
-        self.log.info("write output '%s'" % path)
-        self.log.debug("\n%s", content)
-        self.write_to_file(path, content)
+        document = self.output_document()
+        if self.write_stream_if_changed(
+            path,
+            lambda stream: self.yaml_stream(document, stream),
+        ):
+            self.log.info("wrote output '%s'" % path)
+        else:
+            self.log.info("output '%s' is unchanged" % path)
+
+        if self.options.get('log-output', self.output_log_content):
+            with open(path, 'r') as stream:
+                self.log.debug("\n%s", stream.read())
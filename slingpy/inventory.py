@@ -0,0 +1,138 @@
+import collections
+import re
+import yaml.resolver
+
+
+_roles = {}
+
+
+def intern_roles(roles):
+    '''Return roles as tuple, equal role lists share a single tuple.'''
+    roles = tuple(roles)
+    return _roles.setdefault(roles, roles)
+
+
+class InventoryEntry(object):
+    '''Inventory entry of a machine. Behaves like the read-only dict
+    {'name', 'publicIP', 'privateIP', 'roles'} of the output.yaml schema,
+    addresses which are None are left out. Uses __slots__ and interned
+    role tuples, so large inventories stay small.
+    '''
+    __slots__ = ('name', 'roles', 'public_ip', 'private_ip')
+
+    # output.yaml keys in the order they are dumped
+    _keys = ('name', 'privateIP', 'publicIP', 'roles')
+
+    def __init__(self, name, roles, public_ip=None, private_ip=None):
+        self.name = name
+        self.roles = intern_roles(roles)
+        self.public_ip = public_ip
+        self.private_ip = private_ip
+
+    def _value(self, key):
+        if key == 'name':
+            return self.name
+        if key == 'privateIP':
+            return self.private_ip
+        if key == 'publicIP':
+            return self.public_ip
+        if key == 'roles':
+            return list(self.roles)
+        return None
+
+    def __getitem__(self, key):
+        value = self._value(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._value(key)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self._value(key) is not None
+
+    def __iter__(self):
+        for key in self._keys:
+            if self._value(key) is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def keys(self):
+        return list(iter(self))
+
+    def items(self):
+        return [(key, self._value(key)) for key in self]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (InventoryEntry, collections.Mapping)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'InventoryEntry(%r)' % self.to_dict()
+
+
+collections.Mapping.register(InventoryEntry)
+
+
+# plain scalars which PyYAML writes without quotes, if they resolve to str
+_plain_re = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_./-]*$')
+_resolver = yaml.resolver.Resolver()
+
+
+def _scalar(value):
+    if not isinstance(value, basestring) or _plain_re.match(value) is None:
+        return None
+    tag = _resolver.resolve(yaml.nodes.ScalarNode, value, (True, False))
+    if tag != u'tag:yaml.org,2002:str':
+        return None
+    return str(value)
+
+
+def dump(entries, fallback):
+    '''Return the YAML block sequence of entries, identical to the
+    output of fallback(list of dicts), without going through PyYAML.
+    Entries with values which would need quoting are passed to fallback.
+    '''
+    lines = []
+    for entry in entries:
+        start = len(lines)
+        prefix = '- '
+        for key in entry:
+            if key == 'roles':
+                roles = [_scalar(role) for role in entry.roles]
+                if None in roles:
+                    break
+                if roles:
+                    lines.append('%sroles:\n' % prefix)
+                    lines.extend(['  - %s\n' % role for role in roles])
+                else:
+                    lines.append('%sroles: []\n' % prefix)
+            else:
+                value = _scalar(entry[key])
+                if value is None:
+                    break
+                lines.append('%s%s: %s\n' % (prefix, key, value))
+            prefix = '  '
+        else:
+            continue
+
+        del lines[start:]
+        lines.append(fallback([entry.to_dict()]))
+    return ''.join(lines)
@@ -0,0 +1,176 @@
+import Queue
+import collections
+import re
+import subprocess
+import threading
+import time
+
+
+class ProcessTimeout(Exception):
+    pass
+
+
+class ProcessCancelled(Exception):
+    pass
+
+
+class Process(object):
+    '''Runs a command and drains its stdout and stderr line by line on
+    background threads. Lines are passed to on_line(stream, line) on the
+    thread calling wait(), stream is either 'stdout' or 'stderr'.
+    '''
+    poll_interval = 0.1
+    kill_grace_period = 5
+
+    def __init__(self, args, cwd=None, env=None, timeout=None, on_line=None):
+        self.args = args
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.on_line = on_line
+        self.returncode = None
+        self._proc = None
+        self._queue = Queue.Queue()
+        self._cancelled = threading.Event()
+
+    def _drain(self, name, stream):
+        for line in iter(stream.readline, ''):
+            self._queue.put((name, line))
+        stream.close()
+        self._queue.put((name, None))
+
+    def start(self):
+        self._proc = subprocess.Popen(
+            self.args,
+            cwd=self.cwd,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.started = time.time()
+        for name in ['stdout', 'stderr']:
+            thread = threading.Thread(
+                target=self._drain,
+                args=(name, getattr(self._proc, name)),
+            )
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def cancel(self):
+        '''Stop the process, wait() raises ProcessCancelled. Safe to call
+        from any thread.
+        '''
+        self._cancelled.set()
+
+    def _stop(self):
+        if self._proc.poll() is not None:
+            return
+        self._proc.terminate()
+        deadline = time.time() + self.kill_grace_period
+        while self._proc.poll() is None and time.time() < deadline:
+            time.sleep(self.poll_interval)
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+
+    def wait(self):
+        if self._proc is None:
+            self.start()
+
+        open_streams = 2
+        while open_streams > 0:
+            if self._cancelled.is_set():
+                self._stop()
+                raise ProcessCancelled(self.args)
+            if self.timeout is not None and \
+                    time.time() - self.started > self.timeout:
+                self._stop()
+                raise ProcessTimeout(self.args)
+
+            try:
+                name, line = self._queue.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                continue
+
+            if line is None:
+                open_streams -= 1
+            elif self.on_line is not None:
+                self.on_line(name, line)
+
+        self.returncode = self._proc.wait()
+        return self.returncode
+
+
+ProgressEvent = collections.namedtuple(
+    'ProgressEvent',
+    ['timestamp', 'resource', 'action', 'state', 'duration'],
+)
+
+
+class TerraformProgress(object):
+    '''Parses terraform's per-resource progress lines into ProgressEvents.
+    Events of completed actions carry the duration since their start.
+    '''
+    _ansi_re = re.compile(r'\x1b\[[0-9;]*m')
+    _line_re = re.compile(
+        r'^(?P<resource>[^\s:]+): (?P<message>'
+        r'Creating|Still creating|Creation complete|'
+        r'Destroying|Still destroying|Destruction complete|'
+        r'Modifying|Still modifying|Modifications complete|'
+        r'Refreshing state|Reading|Read complete)'
+    )
+    messages = {
+        'Creating': ('create', 'start'),
+        'Still creating': ('create', 'progress'),
+        'Creation complete': ('create', 'complete'),
+        'Destroying': ('destroy', 'start'),
+        'Still destroying': ('destroy', 'progress'),
+        'Destruction complete': ('destroy', 'complete'),
+        'Modifying': ('modify', 'start'),
+        'Still modifying': ('modify', 'progress'),
+        'Modifications complete': ('modify', 'complete'),
+        'Refreshing state': ('refresh', 'start'),
+        'Reading': ('read', 'start'),
+        'Read complete': ('read', 'complete'),
+    }
+
+    def __init__(self):
+        self.events = []
+        self._started = {}
+
+    def parse(self, line, timestamp=None):
+        '''Return the ProgressEvent for line or None.'''
+        match = self._line_re.match(self._ansi_re.sub('', line).strip())
+        if match is None:
+            return None
+
+        if timestamp is None:
+            timestamp = time.time()
+        resource = match.group('resource')
+        action, state = self.messages[match.group('message')]
+
+        duration = None
+        if state == 'start':
+            self._started[(resource, action)] = timestamp
+        elif state == 'complete':
+            started = self._started.pop((resource, action), None)
+            if started is not None:
+                duration = timestamp - started
+
+        event = ProgressEvent(timestamp, resource, action, state, duration)
+        self.events.append(event)
+        return event
+
+    def durations(self):
+        '''Return (resource, action, duration) of completed actions,
+        slowest first.
+        '''
+        return sorted(
+            [
+                (event.resource, event.action, event.duration)
+                for event in self.events
+                if event.duration is not None
+            ],
+            key=lambda d: -d[2],
+        )
@@ -1,8 +1,42 @@
-from tools import memoized
+from tools import DigestWriter, DiskCache, Overlay
+from tools import file_digest, memoized_property
+from inventory import InventoryEntry
+import inventory
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import hashlib
 import logging
 import yaml
 import os
 import sys
+import tempfile
+import threading
+import tracing
+
+
+# use libyaml when it is available
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class _SafeDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    def ignore_aliases(self, data):
+        return True
+
+
+# overlays are dumped exactly like the merged dict
+_SafeDumper.add_representer(
+    Overlay,
+    lambda dumper, data: dumper.represent_dict(dict(data.shallow_items())),
+)
+_SafeDumper.add_representer(
+    InventoryEntry,
+    lambda dumper, data: dumper.represent_dict(data.to_dict()),
+)
+
+
+class CommandError(Exception):
+    '''Raised by asynchronous commands instead of exiting the process.'''
+    pass
 
 
 class Command(object):
@@ -46,36 +80,173 @@ class Command(object):
 
         return spec
 
+    def bind(self, obj):
+        '''Return a copy whose cmd is the method of obj named by cmd.'''
+        return Command(
+            self._name,
+            cmd=getattr(obj, self._cmd),
+            ctype=self._type,
+            params=self._params,
+            results=self._results,
+            persist=self._persist,
+        )
+
+
+def declare_command(name=None, params=False, results=False, persist=[]):
+    '''Decorator. Declares a provider method as command, name defaults to
+    the method name. Declared commands are discovered without creating a
+    provider instance.
+    '''
+    def decorate(func):
+        func.command = Command(
+            name or func.__name__,
+            cmd=func.__name__,
+            params=params,
+            results=results,
+            persist=persist,
+        )
+        return func
+    return decorate
+
 
 class Provider(object):
     provider_type = None
     commands = {}
+    # directory for a cache of parsed parameters, None disables it
+    parameters_cache_dir = None
+    # log the content of written outputs, also set by --log-output
+    output_log_content = False
+    # number of streamed entries dumped at once
+    yaml_chunk_size = 100
+    # write a trace of each command to this path, also set by --trace=PATH
+    trace_path = None
+    # 'json' or 'chrome', also set by --trace-format=chrome
+    trace_format = 'json'
+    # threads of the executor shared by all asynchronous commands
+    async_workers = 32
+    _executor = None
+    _executor_lock = threading.Lock()
 
-    def __init__(self, ptype):
+    def __init__(self, ptype, workdir=None):
         self.provider_type = ptype
-        self.commands['discover'] = Command('discover', cmd=self.discover)
+        self.options = {}
+        self.workdir = workdir
+        if workdir is not None:
+            self.parameters_file_path = self.path('parameters.yaml')
+            self.output_file_path = self.path('output.yaml')
+        self.commands = dict(self.commands)
+        for declaration in self.declared_commands():
+            self.commands[declaration._name] = declaration.bind(self)
+
+    @classmethod
+    def declared_commands(cls):
+        '''Return the commands declared with @declare_command, including
+        those of base classes.
+        '''
+        declarations = {}
+        for klass in reversed(cls.__mro__):
+            for value in vars(klass).values():
+                declaration = getattr(value, 'command', None)
+                if isinstance(declaration, Command):
+                    declarations[declaration._name] = declaration
+        return [declarations[name] for name in sorted(declarations)]
+
+    @classmethod
+    def discover_document(cls, commands):
+        return {
+            'provider': {
+                'version': 1,
+                'type': cls.provider_type,
+            },
+            'commands': dict([
+                (cmd._name, cmd.discover())
+                for cmd in commands
+            ]),
+        }
+
+    @classmethod
+    def manifest(cls):
+        '''Return the discover output of the declared commands, rendered
+        from the class without creating a provider.
+        '''
+        return yaml.dump(
+            cls.discover_document(cls.declared_commands()),
+            Dumper=_SafeDumper,
+            default_flow_style=False,
+        )
+
+    @classmethod
+    def main(cls, argv):
+        '''Command line entry point. 'discover' prints the manifest
+        without creating a provider, unless the class overrides __init__,
+        which may register further commands.
+        '''
+        if argv[1:] == ['discover'] and \
+                cls.__init__.__module__.startswith('slingpy.'):
+            sys.stdout.write(cls.manifest() + '\n')
+            return
+        cls().command(argv)
+
+    def path(self, *parts):
+        '''Return the absolute path of parts within the working directory,
+        which defaults to the current directory.
+        '''
+        return os.path.abspath(os.path.join(self.workdir or '.', *parts))
 
-    @property
-    @memoized
+    @memoized_property
     def parameters(self):
-        with open(self.parameters_file_path, 'r') as stream:
-            self.my_parameters = yaml.load(stream)
+        with open(self.parameters_file_path, 'r') as stream, \
+                tracing.span('parameters'):
+            if self.parameters_cache_dir is None:
+                self.my_parameters = yaml.load(stream, Loader=_SafeLoader)
+            else:
+                self.my_parameters = self.parameters_cached(stream)
             self.log.info(
                 "read parameters from '%s'" % self.parameters_file_path
             )
             return self.my_parameters
 
-    @property
-    @memoized
+    def parameters_cached(self, stream):
+        content = stream.read()
+        stat = os.fstat(stream.fileno())
+        key = hashlib.sha1('%d-%r-%s' % (
+            stat.st_size,
+            stat.st_mtime,
+            hashlib.sha1(content).hexdigest(),
+        )).hexdigest()
+
+        cache = DiskCache(self.parameters_cache_dir)
+        parameters = cache.get(key)
+        if parameters is None:
+            parameters = yaml.load(content, Loader=_SafeLoader)
+            cache.set(key, parameters)
+        else:
+            self.log.debug("parsed parameters cache hit '%s'" % key)
+        return parameters
+
+    def label(self):
+        '''Return the name of the cluster, the basename of the working
+        directory, or None without working directory.
+        '''
+        if self.workdir is None:
+            return None
+        return os.path.basename(os.path.abspath(self.workdir))
+
+    @memoized_property
     def log(self):
-        l = logging.getLogger(__name__)
+        # one logger per cluster, its name tells the clusters apart
+        name = __name__
+        if self.label() is not None:
+            name = '%s.%s' % (name, self.label().replace('.', '_'))
+        l = logging.getLogger(name)
         l.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-        ch.setFormatter(formatter)
-        l.addHandler(ch)
+        if not l.handlers:
+            ch = logging.StreamHandler()
+            formatter = logging.Formatter(
+                "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+            )
+            ch.setFormatter(formatter)
+            l.addHandler(ch)
         self.my_log = l
         return self.my_log
 
@@ -83,9 +254,84 @@ class Provider(object):
         return self.parameters['custom'][key]
 
     def yaml(self, obj):
-        Dumper = yaml.SafeDumper
-        Dumper.ignore_aliases = lambda self, data: True
-        return yaml.dump(obj, Dumper=Dumper, default_flow_style=False)
+        with tracing.span('yaml dump'):
+            return yaml.dump(
+                obj,
+                Dumper=_SafeDumper,
+                default_flow_style=False,
+            )
+
+    def yaml_stream(self, obj, stream):
+        '''Write obj to stream, byte-identical to yaml(obj). The keys of a
+        mapping are dumped one by one, iterator values are consumed and
+        written in chunks as their entries are produced.
+        '''
+        if not isinstance(obj, collections.Mapping):
+            stream.write(self.yaml(obj))
+            return
+
+        if isinstance(obj, Overlay):
+            items = obj.shallow_items()
+        else:
+            items = obj.iteritems()
+
+        with tracing.span('yaml stream'):
+            for key, value in sorted(items, key=lambda item: item[0]):
+                if not isinstance(value, collections.Iterator):
+                    stream.write(self.yaml({key: value}))
+                    continue
+
+                chunk = []
+                empty = True
+                for entry in value:
+                    if empty:
+                        # block sequences are not indented below their key
+                        stream.write(self.yaml({key: []})[:-len(' []\n')])
+                        stream.write('\n')
+                        empty = False
+                    chunk.append(entry)
+                    if len(chunk) == self.yaml_chunk_size:
+                        stream.write(self.yaml_entries(chunk))
+                        chunk = []
+                if chunk:
+                    stream.write(self.yaml_entries(chunk))
+                if empty:
+                    stream.write(self.yaml({key: []}))
+
+    def yaml_entries(self, entries):
+        '''Return the YAML sequence of entries, inventory entries are
+        written without PyYAML.
+        '''
+        if all(isinstance(entry, InventoryEntry) for entry in entries):
+            return inventory.dump(entries, self.yaml)
+        return self.yaml(entries)
+
+    def write_stream_if_changed(self, path, write):
+        '''Stream the file written by write(stream) to a temporary file and
+        atomically rename it to path, unless path already has the same
+        content. Returns True if the file was written.
+        '''
+        dir_path = os.path.dirname(path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=dir_path,
+            prefix='.%s.' % os.path.basename(path),
+        )
+        try:
+            with os.fdopen(fd, 'w') as stream:
+                writer = DigestWriter(stream)
+                write(writer)
+            if file_digest(path) == writer.hexdigest():
+                os.remove(tmp_path)
+                return False
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        return True
 
     def write_to_file(self, path, content):
         dir_path = os.path.dirname(path)
@@ -95,18 +341,72 @@ class Provider(object):
         with open(path, 'w') as stream:
             stream.write(content)
 
+    def write_to_file_if_changed(self, path, content):
+        '''Atomically replace the file at path with content, unless it
+        already has this content. Returns True if the file was written.
+        '''
+        if file_digest(path) == hashlib.sha1(content).hexdigest():
+            return False
+
+        dir_path = os.path.dirname(path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=dir_path,
+            prefix='.%s.' % os.path.basename(path),
+        )
+        try:
+            with os.fdopen(fd, 'w') as stream:
+                stream.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        return True
+
+    @declare_command()
     def discover(self):
-        cmds = dict([
-            (cmd._name, cmd.discover())
-            for cmd in self.commands.values()
-        ])
-        print(self.yaml({
-            'provider': {
-                'version': 1,
-                'type': self.provider_type,
-            },
-            'commands': cmds,
-        }))
+        print(self.yaml(self.discover_document(self.commands.values())))
+
+    @classmethod
+    def executor(cls):
+        with Provider._executor_lock:
+            if Provider._executor is None:
+                Provider._executor = ThreadPoolExecutor(
+                    max_workers=cls.async_workers,
+                )
+            return Provider._executor
+
+    def submit(self, func, *args, **kwargs):
+        '''Run func on the shared executor and return a
+        concurrent.futures.Future. Fatal errors raise CommandError instead
+        of SystemExit. On python 3 the future can be awaited with
+        asyncio.wrap_future.
+        '''
+        def run():
+            try:
+                return func(*args, **kwargs)
+            except SystemExit as e:
+                raise CommandError(
+                    "'%s' failed with exit code %s" % (
+                        getattr(func, '__name__', func),
+                        e.code,
+                    )
+                )
+        return self.executor().submit(run)
+
+    def parse_options(self, args):
+        '''Parse '--name' and '--name=value' arguments into a dict.'''
+        options = {}
+        for arg in args:
+            if not arg.startswith('--'):
+                print("Unknown argument '%s'" % arg)
+                sys.exit(1)
+            name, sep, value = arg[2:].partition('=')
+            options[name] = value if sep else True
+        return options
 
     def command(self, argv):
         if len(argv) < 2:
@@ -116,9 +416,44 @@ class Provider(object):
             ))
             sys.exit(1)
         cmd = argv[1]
+        if cmd == 'batch':
+            import batch
+            batch.main(type(self), argv)
+            return
+        self.options = self.parse_options(argv[2:])
         try:
             cmd_dict = self.commands[cmd]
-            cmd_dict._cmd()
         except KeyError:
             print("Unknown command '%s'" % cmd)
             sys.exit(1)
+
+        trace_path = self.options.get('trace', self.trace_path)
+        if trace_path is True:
+            trace_path = 'trace.json'
+        if trace_path:
+            # relative to the cluster, batch workers must not share a file
+            trace_path = self.path(trace_path)
+            tracer = tracing.enable()
+        try:
+            with tracing.span('command %s' % cmd):
+                cmd_dict._cmd()
+        finally:
+            if trace_path:
+                tracing.disable()
+                self.trace_write(tracer, trace_path)
+
+    def trace_write(self, tracer, path):
+        trace_format = self.options.get('trace-format', self.trace_format)
+        tracer.write(path, chrome=trace_format == 'chrome')
+        self.log.info("wrote trace '%s'" % path)
+        for name, calls, wall, cpu in tracer.summary():
+            self.log.info(
+                "trace: %-32s %5d calls %9.3fs wall %9.3fs cpu" % (
+                    name,
+                    calls,
+                    wall,
+                    cpu,
+                )
+            )
+        for name, value in sorted(tracer.counts.items()):
+            self.log.info("trace: %-32s %5d" % (name, value))
@@ -1,49 +1,96 @@
-from tools import memoized
+from tools import TaskGraph, caches, file_digest, invalidate, memoized
+from tools import Overlay, memoized_property, ordered_imap, ordered_map
+from tools import plain
 from infra_provider import InfraProvider
-from provider import Command
-from cloud import AWSPlugin, DigitaloceanPlugin
+from provider import declare_command
+from cloud import plugins
+from terraform_state import TerraformState
+from process import Process, ProcessCancelled, ProcessTimeout
+from process import TerraformProgress
+import errno
 import sys
-import subprocess
 import os
+import hashlib
+import platform
+import tracing
 import json
-import copy
+
+
+persist_paths = [
+    'terraform/terraform.tfstate',
+    'terraform/terraform.fingerprint',
+    'terraform/terraform.tfplan',
+    'terraform/terraform.tfplan.serial',
+]
 
 
 class TerraformInfraProvider(InfraProvider):
-    _clouds = []
+    terraform_processes = 0
+    # 'terraform' runs 'terraform output', 'state' reads the state file
+    terraform_output_backend = 'terraform'
+    # number of threads used to gather inventory, 1 disables concurrency
+    concurrency = 1
+    # timeouts in seconds for terraform processes, None waits forever
+    terraform_timeout = None
+    terraform_output_timeout = 300
+    _terraform_process = None
+    # plugin cache shared by all working directories, defaults to
+    # $TF_PLUGIN_CACHE_DIR or ~/.terraform.d/plugin-cache
+    terraform_plugin_cache_dir = None
+    # only install plugins from the plugin cache, also set by --offline
+    terraform_plugin_offline = False
+    # threads running independent phases of a command, 1 runs them one
+    # after the other in a fixed order; also set by --serial
+    phase_workers = 4
+    # registry the cloud plugin is detected from by its required params
+    cloud_plugins = plugins
 
-    def __init__(self):
-        super(TerraformInfraProvider, self).__init__()
+    @memoized_property
+    def cloud(self):
+        with tracing.span('cloud detect'):
+            name = self.cloud_plugins.detect(self.parameters['custom'].keys())
+        if name is None:
+            self.log.fatal("no cloud detected")
+            sys.exit(1)
 
-        self._clouds = [
-            AWSPlugin(self),
-            DigitaloceanPlugin(self),
-        ]
+        self.log.info("cloud '%s' detected" % name)
+        return self.cloud_plugins.load(name)(self)
 
-        for name in ['apply', 'destroy', 'plan', 'graph']:
-            self.commands[name] = Command(
-                name,
-                cmd=getattr(self, name),
-                params=True,
-                results=False,
-                persist=['terraform/terraform.tfstate']
-            )
-        self.commands['apply']._results = True
+    def task_graph(self):
+        if self.options.get('serial') is True:
+            return TaskGraph(workers=1)
+        return TaskGraph(workers=self.phase_workers)
 
-    @property
-    @memoized
-    def cloud(self):
-        for cloud in self._clouds:
-            if cloud.detect():
-                self.log.info("cloud '%s' detected" % cloud.name)
-                return cloud
-            else:
-                self.log.debug("cloud no '%s' detected" % cloud.name)
+    def map(self, func, items):
+        return ordered_map(func, items, self.concurrency)
 
-        self.log.fatal("no cloud detected")
-        sys.exit(1)
+    def imap(self, func, items):
+        return ordered_imap(func, items, self.concurrency)
 
+    @memoized
     def variables(self):
+        '''Return the terraform variables. The cloud's variables, which
+        may need API calls, are computed alongside the cluster's.
+        '''
+        graph = self.task_graph()
+        graph.add('parameters', lambda: self.parameters)
+        graph.add(
+            'cluster variables',
+            self.variables_cluster,
+            after=['parameters'],
+        )
+        graph.add(
+            'cloud variables',
+            lambda: self.cloud.variables(),
+            after=['parameters'],
+        )
+        results = graph.run()
+
+        output = results['cluster variables']
+        output.update(results['cloud variables'])
+        return output
+
+    def variables_cluster(self):
         output = {
             'cluster_name':
             self.parameters['general']['cluster']['name'],
@@ -56,16 +103,12 @@ class TerraformInfraProvider(InfraProvider):
             output['%s_type' % machine_type] = machine['instanceType']
             output['%s_count' % machine_type] = machine['count']
 
-        output.update(self.cloud.variables())
-
         return output
 
-    def terraform_configure(self):
-        self.log.info("variables: %s" % self.variables())
-        path = os.path.join(self.terraform_cwd(), 'terraform.tfvars')
+    def terraform_tfvars(self):
         content = []
 
-        for key, value in self.variables().iteritems():
+        for key, value in sorted(self.variables().iteritems()):
             if type(value) == int or type(value) == str:
                 l = '%s = "%s"' % (key, value)
             elif type(value) == list:
@@ -74,10 +117,20 @@ class TerraformInfraProvider(InfraProvider):
                 continue
             content.append(l)
 
-        for line in content:
+        return '\n'.join(content)
+
+    def terraform_configure(self):
+        self.log.info("variables: %s" % self.variables())
+        path = os.path.join(self.terraform_cwd(), 'terraform.tfvars')
+        content = self.terraform_tfvars()
+
+        for line in content.splitlines():
             self.log.debug('tfvars: %s' % line)
 
-        self.write_to_file(path, '\n'.join(content))
+        if self.write_to_file_if_changed(path, content):
+            self.log.debug("wrote '%s'" % path)
+        else:
+            self.log.debug("'%s' is unchanged" % path)
 
     def terraform_args(self):
         return [
@@ -85,35 +138,267 @@ class TerraformInfraProvider(InfraProvider):
         ]
 
     def terraform_cwd(self):
-        return os.path.abspath('terraform/%s' % self.cloud.name)
+        return self.path('terraform', self.cloud.name)
 
-    def terraform_exec(self, cmd):
-        self.terraform_configure()
+    def terraform_state_path(self):
+        return os.path.abspath(
+            os.path.join(self.terraform_cwd(), '..', 'terraform.tfstate')
+        )
 
-        commands = [
-            'terraform'
-        ] + cmd + self.terraform_args()
+    def terraform_fingerprint_path(self):
+        return os.path.abspath(
+            os.path.join(self.terraform_cwd(), '..', 'terraform.fingerprint')
+        )
 
-        return subprocess.call(
-            commands,
-            cwd=self.terraform_cwd()
+    def terraform_plan_path(self):
+        return os.path.abspath(
+            os.path.join(self.terraform_cwd(), '..', 'terraform.tfplan')
         )
 
-    def terraform_output(self):
-        commands = [
-            'terraform',
-            'output',
-            '-json'
-        ] + self.terraform_args()
-
-        proc = subprocess.Popen(
-            commands,
+    def terraform_state_serial(self):
+        '''Return the state serial as string, 'None' if there is no state
+        yet, or None if the state cannot be read.
+        '''
+        path = self.terraform_state_path()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 'None'
+
+        serial = TerraformState(path).serial()
+        if serial is None:
+            # format not known to TerraformState, parse the whole file
+            try:
+                with open(path, 'r') as stream:
+                    serial = json.load(stream).get('serial')
+            except (IOError, ValueError, AttributeError):
+                return None
+        if not isinstance(serial, (int, long)):
+            return None
+        return str(serial)
+
+    def terraform_plan_remove(self):
+        path = self.terraform_plan_path()
+        for p in [path, '%s.serial' % path]:
+            if os.path.exists(p):
+                os.remove(p)
+
+    def terraform_inputs_digest(self):
+        '''Return a digest of the rendered variables and the .tf sources.'''
+        digest = hashlib.sha1()
+        digest.update('tfvars=%s\n' % self.terraform_tfvars())
+        digest.update('sources=%s\n' % self.terraform_sources_digest())
+        return digest.hexdigest()
+
+    def terraform_fingerprint(self):
+        '''Return a digest of the rendered variables, the .tf sources and
+        the state serial, or None if the state serial is unknown.
+        '''
+        serial = TerraformState(self.terraform_state_path()).serial()
+        if serial is None:
+            return None
+
+        digest = hashlib.sha1()
+        digest.update('serial=%d\n' % serial)
+        digest.update('inputs=%s\n' % self.terraform_inputs_digest())
+        return digest.hexdigest()
+
+    @memoized
+    def terraform_sources_digest(self):
+        '''Return a digest of the .tf files in terraform_cwd(), computed
+        once per command.
+        '''
+        digest = hashlib.sha1()
+        cwd = self.terraform_cwd()
+        for root, dirs, files in os.walk(cwd):
+            dirs[:] = sorted([d for d in dirs if d != '.terraform'])
+            for name in sorted(files):
+                if not name.endswith('.tf'):
+                    continue
+                path = os.path.join(root, name)
+                digest.update('%s=%s\n' % (
+                    os.path.relpath(path, cwd),
+                    file_digest(path),
+                ))
+        return digest.hexdigest()
+
+    def terraform_fingerprint_record(self):
+        path = self.terraform_fingerprint_path()
+        fingerprint = self.terraform_fingerprint()
+        if fingerprint is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        self.write_to_file_if_changed(path, fingerprint)
+        self.log.debug("recorded fingerprint '%s'" % fingerprint)
+
+    def terraform_unchanged(self):
+        '''Return True if nothing changed since the last successful apply.
+        The check is skipped with the --force option.
+        '''
+        if self.options.get('force'):
+            return False
+
+        fingerprint = self.terraform_fingerprint()
+        if fingerprint is None:
+            return False
+
+        try:
+            with open(self.terraform_fingerprint_path(), 'r') as stream:
+                return stream.read().strip() == fingerprint
+        except IOError:
+            return False
+
+    @memoized
+    def terraform_plugin_cache(self):
+        '''Return the plugin cache directory, created once per command,
+        or None if it cannot be created.
+        '''
+        path = self.terraform_plugin_cache_dir
+        if path is None:
+            path = os.environ.get(
+                'TF_PLUGIN_CACHE_DIR',
+                os.path.expanduser('~/.terraform.d/plugin-cache'),
+            )
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # the cache is shared, other processes may have created it
+            if e.errno != errno.EEXIST:
+                self.log.warn(
+                    "cannot create plugin cache '%s': %s" % (path, e)
+                )
+                return None
+        return path
+
+    def terraform_env(self):
+        env = dict(os.environ)
+        cache = self.terraform_plugin_cache()
+        if cache is None:
+            env.pop('TF_PLUGIN_CACHE_DIR', None)
+        else:
+            env['TF_PLUGIN_CACHE_DIR'] = cache
+        return env
+
+    def terraform_run(self, cmd, timeout=None, capture=False):
+        '''Run terraform in terraform_cwd() and return the exit code, stdout
+        and stderr. Without capture the output is passed through line by
+        line and parsed into progress events, passed to terraform_event().
+        '''
+        stdout = []
+        stderr = []
+        progress = TerraformProgress()
+        # lines of concurrently running clusters are told apart by label
+        prefix = ''
+        if self.label() is not None:
+            prefix = '[%s] ' % self.label()
+
+        def on_line(stream, line):
+            if capture:
+                (stdout if stream == 'stdout' else stderr).append(line)
+                return
+            output = getattr(sys, stream)
+            output.write(prefix + line)
+            output.flush()
+            if stream == 'stdout':
+                event = progress.parse(line)
+                if event is not None:
+                    self.terraform_event(event)
+
+        self.terraform_processes += 1
+        tracing.count('terraform processes')
+        self.terraform_progress = progress
+        self._terraform_process = Process(
+            ['terraform'] + cmd,
             cwd=self.terraform_cwd(),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            env=self.terraform_env(),
+            timeout=timeout,
+            on_line=on_line,
+        )
+        try:
+            with tracing.span('terraform %s' % cmd[0]):
+                exitcode = self._terraform_process.wait()
+        except ProcessTimeout:
+            self.log.fatal(
+                "terraform %s timed out after %ss" % (cmd[0], timeout)
+            )
+            sys.exit(1)
+        except ProcessCancelled:
+            self.log.fatal("terraform %s was cancelled" % cmd[0])
+            sys.exit(1)
+        finally:
+            self._terraform_process = None
+
+        for resource, action, duration in progress.durations():
+            self.log.debug(
+                "%s %s took %.1fs" % (resource, action, duration)
+            )
+
+        return exitcode, ''.join(stdout), ''.join(stderr)
+
+    def terraform_cancel(self):
+        '''Cancel the running terraform process, safe to call from any
+        thread.
+        '''
+        process = self._terraform_process
+        if process is not None:
+            process.cancel()
+
+    def terraform_event(self, event):
+        '''Called for every terraform progress event, override to forward
+        live progress.
+        '''
+        self.log.debug(
+            "terraform event: %s %s %s" % (
+                event.resource,
+                event.action,
+                event.state,
+            )
+        )
+
+    def terraform_exec(self, cmd, args=[]):
+        with tracing.span('terraform configure'):
+            self.terraform_configure()
+
+        try:
+            exitcode, _, _ = self.terraform_run(
+                cmd + self.terraform_args() + args,
+                timeout=self.terraform_timeout,
+            )
+            return exitcode
+        finally:
+            # state changing commands invalidate the output snapshot
+            if cmd[0] in ['apply', 'destroy']:
+                self.terraform_output_invalidate()
+
+    @memoized
+    def terraform_output(self):
+        '''Return the parsed terraform outputs, shared by all plugins.
+        The snapshot is read once per command run.
+        '''
+        return self.terraform_output_read()
+
+    def terraform_output_invalidate(self):
+        invalidate(self, 'terraform_output')
+
+    def terraform_output_read(self):
+        if self.terraform_output_backend == 'state':
+            path = self.terraform_state_path()
+            outputs = TerraformState(path).outputs()
+            if outputs is not None:
+                self.log.debug("read terraform outputs from '%s'" % path)
+                return outputs
+            self.log.debug(
+                "state format of '%s' not recognized, "
+                "falling back to terraform" % path
+            )
+
+        return self.terraform_output_exec()
+
+    def terraform_output_exec(self):
+        exitcode, out, err = self.terraform_run(
+            ['output', '-json'] + self.terraform_args(),
+            timeout=self.terraform_output_timeout,
+            capture=True,
         )
-        out, err = proc.communicate()
-        exitcode = proc.returncode
 
         if exitcode != 0:
             self.log.fatal("Retrieving terraform output failed: %s" % err)
@@ -121,30 +406,223 @@ class TerraformInfraProvider(InfraProvider):
 
         return json.loads(out)
 
+    def command(self, argv):
+        try:
+            super(TerraformInfraProvider, self).command(argv)
+        finally:
+            if len(argv) > 1 and argv[1] != 'discover':
+                self.log.info(
+                    "command '%s' spawned %d terraform process(es)" % (
+                        argv[1],
+                        self.terraform_processes,
+                    )
+                )
+                for name, cache in sorted(caches(self).items()):
+                    self.log.debug(
+                        "cache '%s': %d hits, %d misses" % (
+                            name,
+                            cache.hits,
+                            cache.misses,
+                        )
+                    )
+
+    @declare_command(params=True, results=True, persist=persist_paths)
     def apply(self):
-        self.terraform_exec(['apply'])
-        self.output_write()
+        graph = self.task_graph()
+        graph.add('variables', self.variables)
+        graph.add('terraform sources', self.terraform_sources_digest)
+        graph.add('cloud warm up', self.cloud_warm_up)
+        graph.add(
+            'terraform apply',
+            self.apply_terraform,
+            after=['variables', 'terraform sources'],
+        )
+        graph.add(
+            'output write',
+            self.output_write,
+            after=['terraform apply', 'cloud warm up'],
+        )
+        graph.run()
+
+    def apply_terraform(self):
+        if self.terraform_unchanged():
+            self.log.info("no changes since the last apply, skip terraform")
+        elif self.terraform_exec(['apply']) == 0:
+            self.terraform_fingerprint_record()
 
+    def cloud_warm_up(self):
+        '''Prepare the cloud's API clients while terraform runs. Failures
+        are left to surface when the clients are used.
+        '''
+        cloud = self.cloud
+        try:
+            cloud.warm_up()
+        except Exception as e:
+            self.log.debug("cloud warm up failed: %s" % e)
+
+    @declare_command(params=True, persist=persist_paths)
     def destroy(self):
         self.terraform_exec(['destroy', '-force'])
+        path = self.terraform_fingerprint_path()
+        if os.path.exists(path):
+            os.remove(path)
 
+    @declare_command(params=True, persist=persist_paths)
     def plan(self):
+        if self.terraform_unchanged():
+            self.log.info(
+                "No changes. Infrastructure is up-to-date "
+                "since the last apply."
+            )
+            return
         self.terraform_exec(['plan'])
 
+    @declare_command('plan-save', params=True, persist=persist_paths)
+    def plan_save(self):
+        '''Write a plan for apply-plan, together with the state serial
+        and the digest of the variables and sources it was computed from.
+        '''
+        self.terraform_plan_remove()
+        path = self.terraform_plan_path()
+        serial = self.terraform_state_serial()
+        if serial is None:
+            self.log.fatal(
+                "cannot read the serial of '%s'" % self.terraform_state_path()
+            )
+            sys.exit(1)
+        if self.terraform_exec(['plan', '-out=%s' % path]) == 0:
+            self.write_to_file_if_changed(
+                '%s.serial' % path,
+                'serial=%s\ninputs=%s\n' % (
+                    serial,
+                    self.terraform_inputs_digest(),
+                ),
+            )
+            self.log.info("saved plan '%s'" % path)
+
+    @declare_command(
+        'apply-plan',
+        params=True,
+        results=True,
+        persist=persist_paths,
+    )
+    def apply_plan(self):
+        '''Apply the plan written by plan-save, if neither the state nor
+        the variables and sources changed in the meantime.
+        '''
+        path = self.terraform_plan_path()
+        planned = {}
+        try:
+            with open('%s.serial' % path, 'r') as stream:
+                for line in stream:
+                    key, _, value = line.strip().partition('=')
+                    planned[key] = value
+        except IOError:
+            self.log.fatal("no saved plan '%s' found" % path)
+            sys.exit(1)
+
+        serial = self.terraform_state_serial()
+        if serial is None:
+            self.log.fatal(
+                "cannot read the serial of '%s', refusing to apply the plan"
+                % self.terraform_state_path()
+            )
+            self.terraform_plan_remove()
+            sys.exit(1)
+        if planned.get('serial') != serial:
+            self.log.fatal(
+                "state serial changed from %s to %s since the plan was saved"
+                % (planned.get('serial'), serial)
+            )
+            self.terraform_plan_remove()
+            sys.exit(1)
+        # the fingerprint recorded after the apply describes the current
+        # inputs, so they have to be the ones the plan was made from
+        if planned.get('inputs') != self.terraform_inputs_digest():
+            self.log.fatal(
+                "variables or terraform sources changed since the plan "
+                "was saved"
+            )
+            self.terraform_plan_remove()
+            sys.exit(1)
+
+        if self.terraform_exec(['apply'], [path]) == 0:
+            self.terraform_fingerprint_record()
+        self.terraform_plan_remove()
+        self.output_write()
+
+    @declare_command(params=True, persist=persist_paths)
+    def init(self):
+        '''Initialize the terraform working directory from the shared
+        plugin cache. Skipped if it is initialized for the current sources.
+        '''
+        marker = os.path.join(self.terraform_cwd(), '.terraform', 'slingpy')
+        digest = self.terraform_sources_digest()
+        try:
+            with open(marker, 'r') as stream:
+                if stream.read().strip() == digest:
+                    self.log.info("terraform is already initialized")
+                    return
+        except IOError:
+            pass
+
+        args = ['init', '-input=false']
+        if self.terraform_plugin_offline or self.options.get('offline'):
+            cache = self.terraform_plugin_cache()
+            if cache is None:
+                self.log.fatal("offline init needs the plugin cache")
+                sys.exit(1)
+            os_arch = '%s_%s' % (
+                platform.system().lower(),
+                {'x86_64': 'amd64', 'i386': '386', 'i686': '386'}.get(
+                    platform.machine(),
+                    platform.machine(),
+                ),
+            )
+            args += [
+                '-plugin-dir=%s' % cache,
+                '-plugin-dir=%s' % os.path.join(cache, os_arch),
+            ]
+
+        exitcode, _, _ = self.terraform_run(
+            args,
+            timeout=self.terraform_timeout,
+        )
+        if exitcode != 0:
+            self.log.fatal("terraform init failed")
+            sys.exit(1)
+
+        self.write_to_file_if_changed(marker, digest)
+
+    @declare_command(params=True, persist=persist_paths)
     def graph(self):
         self.terraform_exec(['graph'])
 
+    def apply_async(self):
+        return self.submit(self.apply)
+
+    def destroy_async(self):
+        return self.submit(self.destroy)
+
+    def plan_async(self):
+        return self.submit(self.plan)
+
+    def output_async(self):
+        return self.submit(self.output)
+
+    def inventory_async(self):
+        return self.submit(lambda: self.cloud.inventory())
+
+    def output_document(self):
+        with tracing.span('output'):
+            output = Overlay(self.parameters)
+            self.cloud.output(output)
+            return output
+
     def output(self):
-        output = copy.deepcopy(self.parameters)
-        self.cloud.output(output)
-        return output
-        pass
-
-    def output_write(self):
-        path = self.output_file_path
-        content = self.yaml(self.output())
-        self.log.info("write output '%s'" % path)
-        self.log.debug("\n%s", content)
-        self.write_to_file(path, content)
+        '''Return the output as plain dicts and lists, independent of the
+        parameters.
+        '''
+        return plain(self.output_document())
 
     pass
@@ -0,0 +1,109 @@
+import contextlib
+import json
+import mmap
+import os
+import re
+
+
+class TerraformState(object):
+    '''Reads selected parts of a terraform state file.
+
+    The file is memory-mapped and only the header and the root module's
+    outputs are decoded, so large states with many resources are never
+    fully loaded.
+    '''
+    versions = [3, 4]
+
+    _header_re = re.compile(r'\s*\{\s*"version"\s*:\s*(\d+)')
+    _serial_re = re.compile(r'"serial"\s*:\s*(\d+)')
+    _outputs_re = {
+        3: re.compile(
+            r'"path"\s*:\s*\[\s*"root"\s*\]\s*,\s*"outputs"\s*:\s*(?=\{)'
+        ),
+        4: re.compile(r'"outputs"\s*:\s*(?=\{)'),
+    }
+    _token_re = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]')
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _mapped(self):
+        try:
+            stream = open(self.path, 'rb')
+        except IOError:
+            yield None
+            return
+
+        with stream:
+            if os.fstat(stream.fileno()).st_size == 0:
+                yield None
+                return
+            buf = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield buf
+            finally:
+                buf.close()
+
+    def _version(self, buf):
+        match = self._header_re.match(buf)
+        if match is None:
+            return None
+        version = int(match.group(1))
+        if version not in self.versions:
+            return None
+        return version
+
+    def _object_end(self, buf, start):
+        depth = 0
+        for token in self._token_re.finditer(buf, start):
+            value = token.group(0)
+            if value == '{':
+                depth += 1
+            elif value == '}':
+                depth -= 1
+                if depth == 0:
+                    return token.end()
+        return None
+
+    def serial(self):
+        '''Return the state serial or None if the state is not readable.'''
+        with self._mapped() as buf:
+            if buf is None or self._version(buf) is None:
+                return None
+            match = self._serial_re.search(buf)
+            if match is None:
+                return None
+            return int(match.group(1))
+
+    def outputs(self):
+        '''Return the root module outputs in the format of
+        'terraform output -json' or None if the format is not recognized.
+        '''
+        with self._mapped() as buf:
+            if buf is None:
+                return None
+            version = self._version(buf)
+            if version is None:
+                return None
+            match = self._outputs_re[version].search(buf)
+            if match is None:
+                return None
+            end = self._object_end(buf, match.end())
+            if end is None:
+                return None
+            try:
+                outputs = json.loads(buf[match.end():end])
+            except ValueError:
+                return None
+
+        result = {}
+        for key, output in outputs.iteritems():
+            if not isinstance(output, dict) or 'value' not in output:
+                return None
+            result[key] = {
+                'sensitive': output.get('sensitive', False),
+                'type': output.get('type', 'string'),
+                'value': output['value'],
+            }
+        return result
@@ -1,32 +1,459 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import cPickle as pickle
 import collections
-import functools
+import copy
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracing
 
 
-class memoized(object):
-    '''Decorator. Caches a function's return value each time it is called.
-    If called later with the same arguments, the cached value is returned
-    (not reevaluated).
+class Cache(object):
+    '''Thread-safe key/value cache with optional LRU (maxsize) and TTL
+    eviction, explicit invalidation and hit/miss counters.
     '''
-    def __init__(self, func):
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, func):
+        '''Return the value for key, calling func on a miss. The lock is
+        held while func runs, so concurrent callers compute it only once.
+        '''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.time():
+                    self.hits += 1
+                    if self.maxsize is not None:
+                        # move to the end, the most recently used position
+                        del self._data[key]
+                        self._data[key] = entry
+                    return value
+                del self._data[key]
+
+            self.misses += 1
+            value = func()
+
+            expires = None
+            if self.ttl is not None:
+                expires = time.time() + self.ttl
+            self._data[key] = (expires, value)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+            return value
+
+    def invalidate(self, *keys):
+        '''Drop the given keys, or every entry when called without keys.'''
+        with self._lock:
+            if len(keys) == 0:
+                self._data.clear()
+            for key in keys:
+                self._data.pop(key, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
+
+
+def caches(obj):
+    '''Return the per-instance caches of obj by attribute name.'''
+    return obj.__dict__.setdefault('_memoized', {})
+
+
+def invalidate(obj, name):
+    '''Invalidate the memoized attribute name of obj, if it was cached.'''
+    cache = caches(obj).get(name)
+    if cache is not None:
+        cache.invalidate()
+
+
+class _Memoized(object):
+    def __init__(self, func, maxsize=None, ttl=None):
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def cache(self, obj):
+        obj_caches = caches(obj)
+        cache = obj_caches.get(self.__name__)
+        if cache is None:
+            cache = obj_caches.setdefault(
+                self.__name__,
+                Cache(maxsize=self.maxsize, ttl=self.ttl),
+            )
+        return cache
+
+
+class _MemoizedMethod(_Memoized):
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        # not stored on the instance, which would hide overrides of the
+        # method in subclasses from later lookups
+        return _BoundMemoizedMethod(self.func, obj, self.cache(obj))
+
+
+class _BoundMemoizedMethod(object):
+    def __init__(self, func, obj, cache):
         self.func = func
-        self.cache = {}
+        self.obj = obj
+        self.cache = cache
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
 
-    def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
+    def __call__(self, *args, **kwargs):
+        key = args
+        if kwargs:
+            key = args + tuple(sorted(kwargs.items()))
+        try:
+            hash(key)
+        except TypeError:
             # uncacheable. a list, for instance.
             # better to not cache than blow up.
-            return self.func(*args)
-        if args in self.cache:
-            return self.cache[args]
+            return self.func(self.obj, *args, **kwargs)
+        return self.cache.get(
+            key,
+            lambda: self.func(self.obj, *args, **kwargs),
+        )
+
+    def invalidate(self, *keys):
+        self.cache.invalidate(*keys)
+
+
+class _MemoizedProperty(_Memoized):
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return self.cache(obj).get((), lambda: self.func(obj))
+
+    def __set__(self, obj, value):
+        raise AttributeError("can't set attribute '%s'" % self.__name__)
+
+
+def memoized(func=None, maxsize=None, ttl=None):
+    '''Decorator. Caches a method's return value per instance and
+    arguments. Use @memoized or @memoized(maxsize=..., ttl=...).
+    '''
+    if func is None:
+        return lambda func: _MemoizedMethod(func, maxsize, ttl)
+    return _MemoizedMethod(func, maxsize, ttl)
+
+
+def memoized_property(func=None, ttl=None):
+    '''Decorator. Like property, but the value is cached per instance.'''
+    if func is None:
+        return lambda func: _MemoizedProperty(func, ttl=ttl)
+    return _MemoizedProperty(func, ttl=ttl)
+
+
+def file_digest(path, block_size=65536):
+    '''Return the sha1 hex digest of the file at path or None if it
+    cannot be read.
+    '''
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as stream:
+            for block in iter(lambda: stream.read(block_size), ''):
+                digest.update(block)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+class DigestWriter(object):
+    '''Writes to stream and keeps the sha1 digest of everything written.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha1()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.stream.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+class DiskCache(object):
+    '''Pickled values stored in a directory, one file per key. Files are
+    written atomically, so the cache can be shared between processes.
+    '''
+    suffix = '.pickle'
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def _load(self, stream):
+        return pickle.load(stream)
+
+    def _dump(self, value, stream):
+        pickle.dump(value, stream, pickle.HIGHEST_PROTOCOL)
+
+    def get(self, key, max_age=None):
+        '''Return the value stored for key or None. Entries written more
+        than max_age seconds ago are ignored.
+        '''
+        try:
+            with open(self._file(key), 'rb') as stream:
+                if max_age is not None and \
+                        time.time() - os.fstat(stream.fileno()).st_mtime > \
+                        max_age:
+                    return None
+                return self._load(stream)
+        except Exception:
+            # missing or unreadable entries are cache misses
+            return None
+
+    def set(self, key, value):
+        '''Store value for key, return False if it could not be written.'''
+        tmp_path = None
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as stream:
+                self._dump(value, stream)
+            os.rename(tmp_path, self._file(key))
+            return True
+        except (IOError, OSError, TypeError, ValueError):
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+
+class JSONDiskCache(DiskCache):
+    '''DiskCache of JSON values. Loading them runs no code, so the cache
+    may live in a directory other users can write to.
+    '''
+    suffix = '.json'
+
+    def _load(self, stream):
+        return json.load(stream)
+
+    def _dump(self, value, stream):
+        json.dump(value, stream)
+
+
+class Overlay(collections.MutableMapping):
+    '''Copy-on-write view of a dict. Changes are kept in the overlay and
+    the base is never modified. Nested dicts are returned as overlays
+    themselves, other mutable values are copied when first read. Keys
+    iterate in the order of the base followed by added keys.
+    '''
+
+    def __init__(self, base):
+        self._base = base
+        self._changes = {}
+        self._added = []
+        self._deleted = set()
+
+    def __getitem__(self, key):
+        try:
+            return self._changes[key]
+        except KeyError:
+            pass
+        if key in self._deleted:
+            raise KeyError(key)
+
+        value = self._base[key]
+        if isinstance(value, dict):
+            value = Overlay(value)
+        elif isinstance(value, (list, set)):
+            value = copy.deepcopy(value)
         else:
-            value = self.func(*args)
-            self.cache[args] = value
             return value
+        self._changes[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self._base and key not in self._changes:
+            self._added.append(key)
+        self._deleted.discard(key)
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._changes.pop(key, None)
+        if key in self._added:
+            self._added.remove(key)
+        if key in self._base:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._changes:
+            return True
+        return key in self._base and key not in self._deleted
+
+    def __iter__(self):
+        for key in self._base:
+            if key not in self._deleted:
+                yield key
+        for key in self._added:
+            yield key
+
+    def __len__(self):
+        return len(self._base) - len(self._deleted) + len(self._added)
 
     def __repr__(self):
-        '''Return the function's docstring.'''
-        return self.func.__doc__
+        return 'Overlay(%r)' % dict(self.items())
+
+    def shallow_items(self):
+        '''Yield (key, value) pairs without wrapping or copying unchanged
+        values of the base, which must not be modified.
+        '''
+        for key in self:
+            try:
+                yield key, self._changes[key]
+            except KeyError:
+                yield key, self._base[key]
+
+    def merged(self):
+        '''Return the overlay as plain dict, sharing unchanged values with
+        the base.
+        '''
+        return dict(
+            (
+                key,
+                value.merged() if isinstance(value, Overlay) else value,
+            )
+            for key, value in self.shallow_items()
+        )
+
+
+def plain(value):
+    '''Return value with mappings, including overlays, as dicts and
+    sequences and iterators as lists, recursively. Only immutable values
+    are shared with value.
+    '''
+    if isinstance(value, Overlay):
+        return dict(
+            (key, plain(item)) for key, item in value.shallow_items()
+        )
+    if isinstance(value, collections.Mapping):
+        return dict((key, plain(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple, collections.Iterator)):
+        return [plain(item) for item in value]
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+
+def ordered_imap(func, items, workers=1):
+    '''Lazily apply func to every item on up to workers threads. Results
+    are yielded in the order of items, at most workers items are in flight.
+    '''
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def ordered_map(func, items, workers=1):
+    '''Apply func to every item on up to workers threads. The results are
+    returned in the order of items, regardless of completion order.
+    '''
+    items = list(items)
+    return list(ordered_imap(func, items, min(workers, len(items))))
+
+
+class TaskGraph(object):
+    '''Named tasks with dependencies. run() starts each task once the
+    tasks it depends on are done, independent tasks run concurrently on up
+    to workers threads. With workers=1 the tasks run one after the other
+    in the order they were added.
+
+    If tasks fail, no further tasks are started. Once the running tasks
+    are done, the exception of the failed task that was added first is
+    raised, including SystemExit.
+    '''
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._tasks = collections.OrderedDict()
+
+    def add(self, name, func, after=()):
+        '''Add task name, running func() after the tasks named in after,
+        which have to be added before.
+        '''
+        for dependency in after:
+            if dependency not in self._tasks:
+                raise ValueError(
+                    "task '%s' depends on unknown task '%s'" % (
+                        name,
+                        dependency,
+                    )
+                )
+        self._tasks[name] = (func, tuple(after))
+
+    def _call(self, name, func):
+        with tracing.span(name):
+            return func()
+
+    def run(self):
+        '''Run all tasks, return their results by name.'''
+        results = {}
+        if self.workers <= 1:
+            for name, (func, _) in self._tasks.iteritems():
+                results[name] = self._call(name, func)
+            return results
+
+        pending = list(self._tasks)
+        running = {}
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while running or (pending and not failed):
+                if not failed:
+                    for name in list(pending):
+                        func, after = self._tasks[name]
+                        if all(dependency in results for dependency in after):
+                            pending.remove(name)
+                            future = pool.submit(self._call, name, func)
+                            running[future] = name
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except BaseException:
+                        failed[name] = sys.exc_info()
 
-    def __get__(self, obj, objtype):
-        '''Support instance methods.'''
-        return functools.partial(self.__call__, obj)
+        for name in self._tasks:
+            if name in failed:
+                exc_type, exc_value, exc_traceback = failed[name]
+                raise exc_type, exc_value, exc_traceback
+        return results
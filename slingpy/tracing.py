@@ -0,0 +1,198 @@
+import collections
+import json
+import os
+import threading
+import time
+
+
+Span = collections.namedtuple(
+    'Span',
+    ['name', 'start', 'wall', 'cpu', 'thread', 'depth', 'args'],
+)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class NullTracer(object):
+    '''Tracer used while tracing is disabled, spans cost one call.'''
+    enabled = False
+
+    def span(self, name, **args):
+        return _null_span
+
+    def add(self, name, start, wall, **args):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+class _Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.depth = len(stack)
+        stack.append(self.name)
+        self.start = time.time()
+        self.cpu_start = _cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.time() - self.start
+        cpu = _cpu_time() - self.cpu_start
+        self.tracer._stack().pop()
+        self.tracer._record(Span(
+            self.name,
+            self.start,
+            wall,
+            cpu,
+            threading.current_thread().ident,
+            self.depth,
+            self.args,
+        ))
+        return False
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Tracer(object):
+    '''Records nested spans with wall time and process CPU time, and
+    counters. Spans of all threads are collected.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = []
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def span(self, name, **args):
+        return _Span(self, name, args)
+
+    def add(self, name, start, wall, **args):
+        '''Record a span timed elsewhere, for example by event hooks.'''
+        self._record(Span(
+            name,
+            start,
+            wall,
+            0.0,
+            threading.current_thread().ident,
+            len(self._stack()),
+            args,
+        ))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def summary(self):
+        '''Return (name, calls, wall, cpu) per span name, by total wall
+        time.
+        '''
+        totals = collections.OrderedDict()
+        for span in self.spans:
+            calls, wall, cpu = totals.get(span.name, (0, 0.0, 0.0))
+            totals[span.name] = (calls + 1, wall + span.wall, cpu + span.cpu)
+        return sorted(
+            [(name,) + values for name, values in totals.items()],
+            key=lambda s: -s[2],
+        )
+
+    def document(self):
+        return {
+            'started': self.started,
+            'spans': [
+                dict(span._asdict(), start=span.start - self.started)
+                for span in self.spans
+            ],
+            'counts': dict(self.counts),
+        }
+
+    def chrome_document(self):
+        '''Return the spans in the Chrome trace event format.'''
+        pid = os.getpid()
+        events = [
+            {
+                'name': span.name,
+                'ph': 'X',
+                'ts': int((span.start - self.started) * 1e6),
+                'dur': int(span.wall * 1e6),
+                'pid': pid,
+                'tid': span.thread,
+                'args': dict(span.args, cpu=span.cpu),
+            }
+            for span in self.spans
+        ]
+        for name, value in sorted(self.counts.items()):
+            events.append({
+                'name': name,
+                'ph': 'C',
+                'ts': int((time.time() - self.started) * 1e6),
+                'pid': pid,
+                'args': {'count': value},
+            })
+        return {'traceEvents': events}
+
+    def write(self, path, chrome=False):
+        if chrome:
+            document = self.chrome_document()
+        else:
+            document = self.document()
+        with open(path, 'w') as stream:
+            json.dump(document, stream, indent=1, default=str)
+
+
+tracer = NullTracer()
+
+
+def enable():
+    '''Start recording spans and return the new tracer.'''
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+
+def disable():
+    global tracer
+    tracer = NullTracer()
+
+
+def span(name, **args):
+    '''Context manager timing the block as span name.'''
+    return tracer.span(name, **args)
+
+
+def add(name, start, wall, **args):
+    tracer.add(name, start, wall, **args)
+
+
+def count(name, value=1):
+    tracer.count(name, value)
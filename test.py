@@ -7,8 +7,7 @@ class InfraProvider(TerraformInfraProvider):
 
 
 def main():
-    ip = InfraProvider()
-    ip.command(sys.argv)
+    InfraProvider.main(sys.argv)
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,15 @@
 import unittest
+import json
 import mock
 import generic
 import yaml
 import logging
 import os
+import shutil
+import tempfile
+import time
 from slingpy import TerraformInfraProvider
+from slingpy.cloud import AWSClientPool, AWSPlugin
 
 
 def example_output(self):
@@ -67,6 +72,44 @@ def mock_params(custom):
     )
 
 
+def describe_auto_scaling_groups(AutoScalingGroupNames):
+    return [
+        {
+            'AutoScalingGroups': [
+                {
+                    'AutoScalingGroupName': 'worker-asg1',
+                    'Instances': [
+                        {'InstanceId': 'i-worker%d' % i} for i in range(3)
+                    ],
+                },
+            ],
+            'NextToken': 'page2',
+        },
+        {
+            'AutoScalingGroups': [
+                {
+                    'AutoScalingGroupName': 'master-asg1',
+                    'Instances': [{'InstanceId': 'i-master0'}],
+                },
+            ]
+        },
+    ]
+
+
+def describe_instances(InstanceIds):
+    instances = [
+        {
+            'InstanceId': instance_id,
+            'PrivateIpAddress': '10.0.0.%d' % i,
+        }
+        for i, instance_id in reversed(list(enumerate(InstanceIds)))
+    ]
+    return [
+        {'Reservations': [{'Instances': [instance]}]}
+        for instance in instances
+    ]
+
+
 def aws_zones(self):
     return ['eu-west-1a', 'eu-west-1b', 'eu-west-1c']
 
@@ -161,3 +204,161 @@ class TestAwsTerraform(unittest.TestCase):
             out['custom']['flocker_secret_key'],
             'flocker-secret-key1',
         )
+
+    @mock.patch("__builtin__.open", mock_params({
+        'aws_access_key': 'access_key1',
+        'aws_secret_key': 'secret_key1',
+    }))
+    @mock.patch(
+        (
+            'slingpy.terraform_infra_provider.'
+            'TerraformInfraProvider.terraform_output'
+        ),
+        example_output,
+    )
+    @mock.patch(
+        'slingpy.cloud.AWSPlugin.client_ec2',
+        new_callable=mock.PropertyMock,
+    )
+    @mock.patch(
+        'slingpy.cloud.AWSPlugin.client_autscaling',
+        new_callable=mock.PropertyMock,
+    )
+    def test_inventory_paginated(self, autoscaling, ec2):
+        autoscaling_paginate = \
+            autoscaling.return_value.get_paginator.return_value.paginate
+        autoscaling_paginate.side_effect = describe_auto_scaling_groups
+        ec2_paginate = ec2.return_value.get_paginator.return_value.paginate
+        ec2_paginate.side_effect = describe_instances
+
+        ip = TerraformInfraProvider()
+        ip.cloud.describe_instances_chunk_size = 4
+        inventory = ip.cloud.inventory()
+
+        self.assertEqual(autoscaling_paginate.call_count, 1)
+        self.assertEqual(ec2_paginate.call_count, 2)
+        self.assertEqual(
+            [(i['name'], i['roles']) for i in inventory],
+            [
+                ('i-master0', ['master']),
+                ('i-worker0', ['worker']),
+                ('i-worker1', ['worker']),
+                ('i-worker2', ['worker']),
+                ('i-deadbeefcafebeef', ['bastion']),
+            ]
+        )
+        self.assertEqual(inventory[3]['privateIP'], '10.0.0.3')
+        self.assertEqual(inventory[4]['privateIP'], '10.0.0.0')
+        self.assertFalse('publicIP' in inventory[0])
+
+    @mock.patch("boto3.Session")
+    def test_client_pool(self, session):
+        pool = AWSClientPool()
+        credentials = ('access_key1', 'secret_key1', 'eu-west-1')
+        client = pool.client('ec2', credentials)
+        self.assertIs(pool.client('ec2', credentials), client)
+        pool.client('autoscaling', credentials)
+        self.assertEqual(session.call_count, 1)
+        pool.client('ec2', ('access_key1', 'secret_key1', 'us-east-1'))
+        self.assertEqual(session.call_count, 2)
+        pool.clear()
+        pool.client('ec2', credentials)
+        self.assertEqual(session.call_count, 3)
+
+    @mock.patch("__builtin__.open", mock_params({
+        'aws_access_key': 'access_key1',
+        'aws_secret_key': 'secret_key1',
+    }))
+    @mock.patch("slingpy.cloud.AWSPlugin.zones_available")
+    def test_terraform_tfvars(self, zones_available):
+        zones_available.return_value = aws_zones(None)
+        ip = TerraformInfraProvider()
+        ip.variables()
+        content = ip.terraform_tfvars()
+        self.assertEqual(zones_available.call_count, 1)
+        self.assertEqual(content, ip.terraform_tfvars())
+        self.assertTrue(
+            'zones = "eu-west-1a,eu-west-1b,eu-west-1c"' in content.split('\n')
+        )
+
+
+class TestAwsMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        if os.environ.get('DEBUG') is None:
+            logging.disable(logging.CRITICAL)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def plugin(self, access_key='access_key1', options={}):
+        provider = mock.Mock()
+        provider.options = options
+        provider.custom_param.side_effect = lambda key: {
+            'aws_access_key': access_key,
+            'aws_secret_key': 'secret_key1',
+        }[key]
+        plugin = AWSPlugin(provider)
+        plugin.metadata_cache_dir = self.dir
+        plugin.zones_describe = mock.Mock(return_value=aws_zones(None))
+        return plugin
+
+    def test_shared(self):
+        plugin = self.plugin()
+        self.assertEqual(plugin.zones_available(), aws_zones(None))
+
+        other = self.plugin()
+        self.assertEqual(other.zones_available(), aws_zones(None))
+        self.assertEqual(other.zones_describe.call_count, 0)
+
+        account = self.plugin(access_key='access_key2')
+        account.zones_available()
+        self.assertEqual(account.zones_describe.call_count, 1)
+        for name in os.listdir(self.dir):
+            with open(os.path.join(self.dir, name)) as stream:
+                content = stream.read()
+            self.assertFalse('access_key' in content)
+            self.assertEqual(json.loads(content), aws_zones(None))
+
+    def test_expired(self):
+        self.plugin().zones_available()
+        plugin = self.plugin()
+        plugin.metadata_cache_ttl = 60
+        with mock.patch('time.time', return_value=time.time() + 120):
+            plugin.zones_available()
+        self.assertEqual(plugin.zones_describe.call_count, 1)
+
+    def test_offline(self):
+        plugin = self.plugin(options={'offline': True})
+        self.assertEqual(plugin.zones_available(), None)
+        with self.assertRaises(SystemExit):
+            plugin.zones()
+        self.assertEqual(plugin.zones_describe.call_count, 0)
+
+        params = {
+            'aws_access_key': 'access_key1',
+            'aws_secret_key': 'secret_key1',
+            'aws_zones': 'eu-west-1a,eu-west-1x',
+        }
+        plugin._provider.custom_param.side_effect = lambda key: params[key]
+        self.assertEqual(plugin.zones(), ['eu-west-1a', 'eu-west-1x'])
+
+        self.plugin().zones_available()
+        plugin.metadata_cache_ttl = 0
+        self.assertEqual(plugin.zones_available(), aws_zones(None))
+        self.assertEqual(plugin.zones_describe.call_count, 0)
+
+    def test_stale_ok(self):
+        self.plugin().zones_available()
+
+        plugin = self.plugin(options={'metadata-cache': 'stale-ok'})
+        plugin.metadata_cache_ttl = -1
+        plugin.zones_describe.side_effect = IOError('unreachable')
+        self.assertEqual(plugin.zones_available(), aws_zones(None))
+
+        plugin = self.plugin()
+        plugin.metadata_cache_ttl = -1
+        plugin.zones_describe.side_effect = IOError('unreachable')
+        with self.assertRaises(IOError):
+            plugin.zones_available()
@@ -0,0 +1,92 @@
+import unittest
+import mock
+import generic
+import yaml
+import tempfile
+import shutil
+import os
+from slingpy import InfraProvider, batch
+from slingpy.provider import Command
+
+
+class NameProvider(InfraProvider):
+
+    def __init__(self, workdir=None):
+        super(NameProvider, self).__init__(workdir=workdir)
+        self.commands['name'] = Command('name', cmd=self.name)
+
+    def name(self):
+        self.write_to_file(
+            self.path('name.txt'),
+            self.parameters['general']['cluster']['name'] +
+            ('!' if self.options.get('shout') else ''),
+        )
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cluster(self, name, params=True):
+        path = os.path.join(self.dir, name)
+        os.makedirs(path)
+        if params:
+            p = generic.generic_yaml()
+            p['general']['cluster']['name'] = name
+            with open(os.path.join(path, 'parameters.yaml'), 'w') as stream:
+                stream.write(yaml.dump(p))
+        return path
+
+    def test_run(self):
+        workdirs = [self.cluster('c%d' % i) for i in range(3)]
+        workdirs.append(self.cluster('broken', params=False))
+
+        results = batch.run(NameProvider, 'name', workdirs, processes=2)
+
+        self.assertEqual([r['cluster'] for r in results], workdirs)
+        self.assertEqual(
+            [r['status'] for r in results],
+            ['ok', 'ok', 'ok', 'failed'],
+        )
+        self.assertTrue(results[3]['error'].startswith('IOError'))
+        for i in range(3):
+            with open(os.path.join(workdirs[i], 'name.txt')) as stream:
+                self.assertEqual(stream.read(), 'c%d' % i)
+        self.assertTrue(
+            os.path.exists(os.path.join(workdirs[0], 'slingpy.log'))
+        )
+        self.assertTrue('1 failed' in batch.summary(results, 1))
+
+    def test_run_options_missing_cluster(self):
+        workdirs = [
+            self.cluster('c0'),
+            os.path.join(self.dir, 'missing'),
+        ]
+
+        results = batch.run(
+            NameProvider,
+            'name',
+            workdirs,
+            processes=2,
+            options=['--shout'],
+        )
+
+        self.assertEqual([r['status'] for r in results], ['ok', 'failed'])
+        self.assertTrue(results[1]['error'].startswith('IOError'))
+        with open(os.path.join(workdirs[0], 'name.txt')) as stream:
+            self.assertEqual(stream.read(), 'c0!')
+
+    @mock.patch('slingpy.batch.run', return_value=[])
+    @mock.patch('sys.stdout')
+    def test_main_options(self, stdout, run):
+        batch.main(NameProvider, [
+            'provider', 'batch', 'apply', 'c1', '--force', 'c2',
+            '--processes=3',
+        ])
+        run.assert_called_with(
+            NameProvider, 'apply', ['c1', 'c2'], 3, ['--force'],
+        )
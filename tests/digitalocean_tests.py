@@ -1,3 +1,5 @@
+import copy
+import json
 import unittest
 import mock
 import generic
@@ -53,6 +55,21 @@ def example_output(self):
     }
 
 
+def example_output_lists(self):
+    output = example_output(self)
+    for key, value in output.items():
+        if key.endswith('s'):
+            value[u'type'] = u'list'
+            value[u'value'] = value[u'value'].split(',')
+    return output
+
+
+def example_output_mismatch(self):
+    output = example_output(self)
+    output[u'worker_public_ips'][u'value'] = u'178.62.59.210'
+    return output
+
+
 def mock_params(custom):
     params = generic.generic_yaml()
     params['general']['cluster']['name'] = 'slingshot-digitalocean'
@@ -110,3 +127,113 @@ class TestAwsTerraform(unittest.TestCase):
         )
         self.assertTrue('139.59.200.249' in k8soutput['masterSan'])
         self.assertTrue('178.62.44.51' in k8soutput['masterSan'])
+
+    @mock.patch("__builtin__.open", mock_params({
+        'digitalocean_token': 'digitalocean_token1',
+    }))
+    @mock.patch(
+        (
+            'slingpy.terraform_infra_provider.'
+            'TerraformInfraProvider.terraform_output'
+        ),
+        example_output,
+    )
+    def test_terraform_output_overlay(self):
+        ip = TerraformInfraProvider()
+        parameters = copy.deepcopy(ip.parameters)
+        output = ip.output()
+        self.assertEqual(ip.parameters, parameters)
+
+        merged = copy.deepcopy(parameters)
+        ip.cloud.output(merged)
+        merged['inventory'] = list(merged['inventory'])
+        self.assertEqual(ip.yaml(output), ip.yaml(merged))
+
+        # plain data, independent of the parameters
+        self.assertEqual(type(output), dict)
+        self.assertEqual(type(output['general']['cluster']), dict)
+        self.assertEqual(type(output['inventory'][0]), dict)
+        json.dumps(output)
+        self.assertEqual(
+            yaml.safe_dump(output, default_flow_style=False),
+            ip.yaml(merged),
+        )
+        output['general']['authentication']['ssh']['user'] = 'changed'
+        self.assertEqual(ip.parameters, parameters)
+
+    @mock.patch("__builtin__.open", mock_params({
+        'digitalocean_token': 'digitalocean_token1',
+    }))
+    def test_terraform_output_snapshot(self):
+        ip = TerraformInfraProvider()
+        with mock.patch.object(
+            ip,
+            'terraform_output_read',
+            return_value=example_output(None),
+        ) as read:
+            ip.output()
+            ip.output()
+            self.assertEqual(read.call_count, 1)
+            ip.terraform_output_invalidate()
+            ip.output()
+            self.assertEqual(read.call_count, 2)
+
+    @mock.patch("__builtin__.open", mock_params({
+        'digitalocean_token': 'digitalocean_token1',
+    }))
+    @mock.patch(
+        (
+            'slingpy.terraform_infra_provider.'
+            'TerraformInfraProvider.terraform_output'
+        ),
+        example_output,
+    )
+    def test_inventory_concurrent(self):
+        ip = TerraformInfraProvider()
+        serial = ip.cloud.inventory()
+        ip.concurrency = 4
+        self.assertEqual(ip.cloud.inventory(), serial)
+
+        # compact entries stay internal, consumers get plain dicts
+        self.assertEqual(set(type(entry) for entry in serial), set([dict]))
+        self.assertEqual(json.loads(json.dumps(serial)), serial)
+        self.assertEqual(yaml.safe_load(yaml.safe_dump(serial)), serial)
+        self.assertEqual(
+            ip.inventory_async().result()[0].values(),
+            serial[0].values(),
+        )
+
+    @mock.patch("__builtin__.open", mock_params({
+        'digitalocean_token': 'digitalocean_token1',
+    }))
+    @mock.patch(
+        (
+            'slingpy.terraform_infra_provider.'
+            'TerraformInfraProvider.terraform_output'
+        ),
+        example_output_lists,
+    )
+    def test_machines_list_native_lists(self):
+        ip = TerraformInfraProvider()
+        machines = list(ip.cloud.machines_list('worker'))
+        self.assertEqual(machines[1], {
+            'hostname': 'kube-slingshot-do-worker-2',
+            'private_ip': '10.131.23.219',
+            'public_ip': '178.62.57.249',
+        })
+        self.assertEqual(len(ip.output()['inventory']), 3)
+
+    @mock.patch("__builtin__.open", mock_params({
+        'digitalocean_token': 'digitalocean_token1',
+    }))
+    @mock.patch(
+        (
+            'slingpy.terraform_infra_provider.'
+            'TerraformInfraProvider.terraform_output'
+        ),
+        example_output_mismatch,
+    )
+    def test_machines_list_mismatch(self):
+        ip = TerraformInfraProvider()
+        with self.assertRaises(SystemExit):
+            list(ip.cloud.machines_list('worker'))
@@ -0,0 +1,39 @@
+import unittest
+import yaml
+from slingpy.inventory import InventoryEntry, dump
+
+
+def safe_dump(obj):
+    return yaml.dump(obj, Dumper=yaml.SafeDumper, default_flow_style=False)
+
+
+class TestInventory(unittest.TestCase):
+
+    def test_entry(self):
+        entry = InventoryEntry('i-1', ['master'], private_ip='10.0.0.1')
+        self.assertEqual(entry, {
+            'name': 'i-1',
+            'privateIP': '10.0.0.1',
+            'roles': ['master'],
+        })
+        self.assertEqual(entry['roles'], ['master'])
+        self.assertFalse('publicIP' in entry)
+        self.assertEqual(entry.get('publicIP'), None)
+        with self.assertRaises(KeyError):
+            entry['publicIP']
+        self.assertEqual(list(entry), ['name', 'privateIP', 'roles'])
+        self.assertFalse(hasattr(entry, '__dict__'))
+        self.assertIs(entry.roles, InventoryEntry('i-2', ['master']).roles)
+
+    def test_dump(self):
+        entries = [
+            InventoryEntry('i-1', ['master'], '1.2.3.4', '10.0.0.1'),
+            InventoryEntry(u'i-2', ('worker', 'etcd'), private_ip=u'10.0.0.2'),
+            InventoryEntry('yes', ['worker'], '1.2.3.5'),
+            InventoryEntry('i-3', ['2016-01-01', 'a b'], '1.2.3.6'),
+            InventoryEntry('i-4', []),
+        ]
+        self.assertEqual(
+            dump(entries, safe_dump),
+            safe_dump([entry.to_dict() for entry in entries]),
+        )
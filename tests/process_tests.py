@@ -0,0 +1,63 @@
+import unittest
+import threading
+import sys
+from slingpy.process import Process, ProcessCancelled, ProcessTimeout
+from slingpy.process import TerraformProgress
+
+
+class TestProcess(unittest.TestCase):
+
+    def test_lines(self):
+        lines = []
+        process = Process(
+            [
+                sys.executable, '-c',
+                'import sys; print "a"; sys.stderr.write("b\\n"); print "c"',
+            ],
+            on_line=lambda stream, line: lines.append((stream, line)),
+        )
+        self.assertEqual(process.wait(), 0)
+        self.assertEqual(
+            [line for line in lines if line[0] == 'stdout'],
+            [('stdout', 'a\n'), ('stdout', 'c\n')],
+        )
+        self.assertTrue(('stderr', 'b\n') in lines)
+
+    def test_timeout(self):
+        process = Process(
+            [sys.executable, '-c', 'import time; time.sleep(10)'],
+            timeout=0.2,
+        )
+        with self.assertRaises(ProcessTimeout):
+            process.wait()
+
+    def test_cancel(self):
+        process = Process(
+            [sys.executable, '-c', 'import time; time.sleep(10)'],
+        ).start()
+        threading.Timer(0.2, process.cancel).start()
+        with self.assertRaises(ProcessCancelled):
+            process.wait()
+
+
+class TestTerraformProgress(unittest.TestCase):
+
+    def test_parse(self):
+        progress = TerraformProgress()
+        self.assertEqual(progress.parse('Plan: 1 to add', 0), None)
+        progress.parse('\x1b[0m\x1b[1maws_instance.bastion: Creating...', 10)
+        progress.parse(
+            'aws_instance.bastion: Still creating... (10s elapsed)', 20
+        )
+        event = progress.parse(
+            'aws_instance.bastion: Creation complete (ID: i-1)', 25
+        )
+        self.assertEqual(event.resource, 'aws_instance.bastion')
+        self.assertEqual(event.action, 'create')
+        self.assertEqual(event.state, 'complete')
+        self.assertEqual(event.duration, 15)
+        self.assertEqual(len(progress.events), 3)
+        self.assertEqual(
+            progress.durations(),
+            [('aws_instance.bastion', 'create', 15)],
+        )
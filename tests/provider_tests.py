@@ -0,0 +1,426 @@
+import unittest
+import mock
+import generic
+import yaml
+import logging
+import tempfile
+import shutil
+import os
+import StringIO
+from slingpy import TerraformInfraProvider
+from slingpy.provider import CommandError, declare_command
+from slingpy.cloud import PluginRegistry, DigitaloceanPlugin
+
+
+def aws_zones(self):
+    return ['eu-west-1a', 'eu-west-1b', 'eu-west-1c']
+
+
+class ExtraProvider(TerraformInfraProvider):
+
+    @declare_command(params=True)
+    def extra(self):
+        pass
+
+
+class TestProvider(unittest.TestCase):
+
+    def setUp(self):
+        if os.environ.get('DEBUG') is None:
+            logging.disable(logging.CRITICAL)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'parameters.yaml')
+        with open(self.path, 'w') as stream:
+            stream.write(yaml.dump(generic.generic_yaml()))
+        # keep terraform runs away from the plugin cache in $HOME
+        environ = mock.patch.dict(os.environ, {
+            'TF_PLUGIN_CACHE_DIR': os.path.join(self.dir, 'plugin-cache'),
+        })
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, content):
+        path = os.path.join(self.dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as stream:
+            stream.write(content)
+
+    def terraform_dir(self):
+        params = generic.generic_yaml()
+        params['custom'] = {
+            'aws_access_key': 'access_key1',
+            'aws_secret_key': 'secret_key1',
+        }
+        self.write('parameters.yaml', yaml.dump(params))
+        self.write('terraform/aws/main.tf', 'variable "region" {}\n')
+        self.write(
+            'terraform/terraform.tfstate',
+            '{"version": 3, "serial": 1, "modules": []}',
+        )
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.addCleanup(os.chdir, cwd)
+
+    def provider(self):
+        ip = TerraformInfraProvider()
+        ip.parameters_file_path = self.path
+        ip.parameters_cache_dir = os.path.join(self.dir, 'cache')
+        return ip
+
+    def test_parameters_cache(self):
+        params = self.provider().parameters
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, 'cache'))), 1)
+
+        with mock.patch('slingpy.provider.yaml.load') as load:
+            self.assertEqual(self.provider().parameters, params)
+            self.assertEqual(load.call_count, 0)
+
+        with open(self.path, 'a') as stream:
+            stream.write('custom: {}\n')
+        self.assertEqual(self.provider().parameters['custom'], {})
+
+    def test_cluster_logs(self):
+        providers = [
+            TerraformInfraProvider(workdir=os.path.join(self.dir, name))
+            for name in ['c1', 'c2', 'c1']
+        ]
+        logs = [ip.log for ip in providers]
+        self.assertEqual(logs[0].name, 'slingpy.provider.c1')
+        self.assertIsNot(logs[0], logs[1])
+        self.assertIs(logs[0], logs[2])
+        for log in logs:
+            self.assertEqual(len(log.handlers), 1)
+
+        ip = providers[0]
+
+        class FakeProcess(object):
+            def __init__(self, args, on_line, **kwargs):
+                self.on_line = on_line
+
+            def wait(self):
+                self.on_line('stdout', 'Plan: 1 to add\n')
+                return 0
+
+        with mock.patch(
+            'slingpy.terraform_infra_provider.Process',
+            FakeProcess,
+        ), mock.patch.object(
+            ip,
+            'terraform_cwd',
+            return_value=self.dir,
+        ), mock.patch('sys.stdout') as stdout:
+            ip.terraform_run(['plan'])
+        stdout.write.assert_called_with('[c1] Plan: 1 to add\n')
+
+    def test_yaml_no_aliases(self):
+        roles = ['master']
+        content = self.provider().yaml({'a': roles, 'b': roles})
+        self.assertEqual(content, 'a:\n- master\nb:\n- master\n')
+
+    def test_write_to_file_if_changed(self):
+        ip = self.provider()
+        path = os.path.join(self.dir, 'terraform', 'terraform.tfvars')
+        self.assertTrue(ip.write_to_file_if_changed(path, 'a = "1"'))
+        os.utime(path, (0, 0))
+        self.assertFalse(ip.write_to_file_if_changed(path, 'a = "1"'))
+        self.assertEqual(os.stat(path).st_mtime, 0)
+        self.assertTrue(ip.write_to_file_if_changed(path, 'a = "2"'))
+        with open(path) as stream:
+            self.assertEqual(stream.read(), 'a = "2"')
+        self.assertEqual(os.listdir(os.path.dirname(path)), [
+            'terraform.tfvars',
+        ])
+
+    def test_yaml_stream(self):
+        ip = self.provider()
+        ip.yaml_chunk_size = 2
+        entries = [{'name': 'm%d' % i, 'roles': ['master']} for i in range(5)]
+        document = {'b': {'c': 1}, 'a': 'x', 'inventory': entries}
+
+        for value in [entries, []]:
+            stream = StringIO.StringIO()
+            ip.yaml_stream(dict(document, inventory=iter(value)), stream)
+            self.assertEqual(
+                stream.getvalue(),
+                ip.yaml(dict(document, inventory=value)),
+            )
+
+    def test_output_write(self):
+        params = generic.generic_yaml()
+        params['custom'] = {'digitalocean_token': 'token1'}
+        self.write('parameters.yaml', yaml.dump(params))
+        ip = self.provider()
+        ip.output_file_path = os.path.join(self.dir, 'output.yaml')
+        outputs = {}
+        for mtype, count in [('master', 1), ('worker', 2)]:
+            for name in ['hostnames', 'private_ips', 'public_ips']:
+                outputs['%s_%s' % (mtype, name)] = {'value': ','.join([
+                    '%s-%s-%d' % (mtype, name, i) for i in range(count)
+                ])}
+        outputs['master_floating_ip'] = {'value': '1.2.3.4'}
+
+        with mock.patch.object(ip, 'terraform_output', return_value=outputs):
+            ip.output_write()
+            with open(ip.output_file_path) as stream:
+                self.assertEqual(stream.read(), ip.yaml(ip.output()))
+
+            os.utime(ip.output_file_path, (0, 0))
+            ip.output_write()
+            self.assertEqual(os.stat(ip.output_file_path).st_mtime, 0)
+
+            with mock.patch.object(
+                ip.cloud,
+                'machines_list',
+                side_effect=IOError('failed'),
+            ):
+                with self.assertRaises(IOError):
+                    ip.output_write()
+        self.assertEqual(os.stat(ip.output_file_path).st_mtime, 0)
+        self.assertEqual(sorted(os.listdir(self.dir)), [
+            'cache',
+            'output.yaml',
+            'parameters.yaml',
+        ])
+
+    @mock.patch("slingpy.cloud.AWSPlugin.warm_up")
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.output_write'
+    )
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.terraform_exec',
+        return_value=0,
+    )
+    def test_apply_phases(self, terraform_exec, output_write, warm_up):
+        self.terraform_dir()
+        calls = []
+        terraform_exec.side_effect = lambda *args: calls.append('exec') or 0
+        output_write.side_effect = lambda: calls.append('output')
+        warm_up.side_effect = lambda: calls.append('warm up')
+
+        for options in [{'serial': True}, {}]:
+            del calls[:]
+            ip = self.provider()
+            ip.options = dict(options, force=True)
+            with mock.patch.object(
+                type(ip.cloud),
+                'zones_available',
+                lambda self: calls.append('zones') or aws_zones(self),
+            ):
+                ip.apply()
+            if options:
+                self.assertEqual(
+                    calls,
+                    ['zones', 'warm up', 'exec', 'output'],
+                )
+            self.assertEqual(calls[-1], 'output')
+            self.assertEqual(sorted(calls), sorted([
+                'zones', 'warm up', 'exec', 'output',
+            ]))
+
+        for options in [{'serial': True}, {}]:
+            ip = self.provider()
+            ip.options = dict(options, force=True)
+            with mock.patch.object(
+                type(ip.cloud),
+                'zones_available',
+                side_effect=SystemExit(1),
+            ):
+                with self.assertRaises(SystemExit):
+                    ip.apply()
+        self.assertEqual(terraform_exec.call_count, 2)
+
+    @mock.patch("slingpy.cloud.AWSPlugin.zones_available", aws_zones)
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.output_write'
+    )
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.terraform_exec',
+        return_value=0,
+    )
+    def test_apply_fingerprint(self, terraform_exec, output_write):
+        self.terraform_dir()
+
+        self.provider().apply()
+        self.assertEqual(terraform_exec.call_count, 1)
+        self.assertTrue(os.path.exists('terraform/terraform.fingerprint'))
+
+        self.provider().apply()
+        self.provider().plan()
+        self.assertEqual(terraform_exec.call_count, 1)
+        self.assertEqual(output_write.call_count, 2)
+
+        ip = self.provider()
+        ip.options = {'force': True}
+        ip.plan()
+        self.assertEqual(terraform_exec.call_count, 2)
+
+        self.write('terraform/aws/main.tf', 'variable "zones" {}\n')
+        self.provider().apply()
+        self.assertEqual(terraform_exec.call_count, 3)
+
+    @mock.patch("slingpy.cloud.AWSPlugin.zones_available", aws_zones)
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.output_write'
+    )
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.terraform_exec',
+        return_value=0,
+    )
+    def test_saved_plan(self, terraform_exec, output_write):
+        self.terraform_dir()
+        plan = os.path.join(self.dir, 'terraform', 'terraform.tfplan')
+
+        self.provider().plan_save()
+        terraform_exec.assert_called_with(['plan', '-out=%s' % plan])
+        self.provider().apply_plan()
+        terraform_exec.assert_called_with(['apply'], [plan])
+        self.assertEqual(output_write.call_count, 1)
+        self.assertFalse(os.path.exists('%s.serial' % plan))
+
+        with self.assertRaises(SystemExit):
+            self.provider().apply_plan()
+
+        self.provider().plan_save()
+        self.write(
+            'terraform/terraform.tfstate',
+            '{"version": 3, "serial": 2, "modules": []}',
+        )
+        with self.assertRaises(SystemExit):
+            self.provider().apply_plan()
+        self.assertEqual(terraform_exec.call_count, 3)
+
+        # states of unknown formats never match a saved plan
+        for state in ['{"version": 9, "serial": 3}', '{"version": 9}']:
+            self.provider().plan_save()
+            self.write('terraform/terraform.tfstate', state)
+            with self.assertRaises(SystemExit):
+                self.provider().apply_plan()
+        with self.assertRaises(SystemExit):
+            self.provider().plan_save()
+        self.assertEqual(terraform_exec.call_count, 5)
+
+        # a plan of other parameters is refused, it would be fingerprinted
+        # as the current ones
+        self.write(
+            'terraform/terraform.tfstate',
+            '{"version": 3, "serial": 3, "modules": []}',
+        )
+        self.provider().plan_save()
+        params = yaml.load(open(self.path))
+        params['general']['cluster']['machines']['worker']['count'] = 3
+        self.write('parameters.yaml', yaml.dump(params))
+        with self.assertRaises(SystemExit):
+            self.provider().apply_plan()
+        self.assertEqual(terraform_exec.call_count, 6)
+
+    @mock.patch("slingpy.cloud.AWSPlugin.zones_available", aws_zones)
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.output_write'
+    )
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.terraform_exec',
+        return_value=0,
+    )
+    def test_async(self, terraform_exec, output_write):
+        self.terraform_dir()
+        futures = [self.provider().plan_async() for _ in range(3)]
+        self.assertEqual([f.result() for f in futures], [None] * 3)
+        self.assertEqual(terraform_exec.call_count, 3)
+
+        ip = self.provider()
+        ip.parameters_file_path = os.path.join(self.dir, 'missing.yaml')
+        with self.assertRaises(IOError):
+            ip.plan_async().result()
+
+        with mock.patch.object(ip, 'plan', side_effect=SystemExit(1)):
+            with self.assertRaises(CommandError):
+                ip.plan_async().result()
+
+    @mock.patch("slingpy.cloud.AWSPlugin.zones_available", aws_zones)
+    @mock.patch(
+        'slingpy.terraform_infra_provider.'
+        'TerraformInfraProvider.terraform_run',
+        return_value=(0, '', ''),
+    )
+    def test_init(self, terraform_run):
+        self.terraform_dir()
+        cache = os.path.join(self.dir, 'plugins')
+
+        ip = self.provider()
+        ip.terraform_plugin_cache_dir = cache
+        ip.init()
+        terraform_run.assert_called_with(
+            ['init', '-input=false'],
+            timeout=None,
+        )
+        self.assertEqual(ip.terraform_env()['TF_PLUGIN_CACHE_DIR'], cache)
+
+        # already created, for instance by another batch worker
+        ip = self.provider()
+        ip.terraform_plugin_cache_dir = cache
+        self.assertEqual(ip.terraform_plugin_cache(), cache)
+
+        self.provider().init()
+        self.assertEqual(terraform_run.call_count, 1)
+
+        # terraform runs without a cache which cannot be created
+        ip = self.provider()
+        ip.terraform_plugin_cache_dir = os.path.join(self.path, 'plugins')
+        self.assertEqual(ip.terraform_plugin_cache(), None)
+        self.assertFalse('TF_PLUGIN_CACHE_DIR' in ip.terraform_env())
+
+        self.write('terraform/aws/main.tf', 'variable "zones" {}\n')
+        ip = self.provider()
+        ip.terraform_plugin_cache_dir = cache
+        ip.options = {'offline': True}
+        ip.init()
+        self.assertEqual(terraform_run.call_count, 2)
+        self.assertTrue(
+            '-plugin-dir=%s' % cache in terraform_run.call_args[0][0]
+        )
+
+    def test_plugin_registry(self):
+        registry = PluginRegistry()
+        registry.register(
+            'fake',
+            'slingpy.cloud:DigitaloceanPlugin',
+            ['token'],
+        )
+        self.assertEqual(registry.detect(['fake_token', 'other']), 'fake')
+        self.assertFalse(registry._entry_points_loaded)
+        self.assertIs(registry.load('fake'), DigitaloceanPlugin)
+        self.assertEqual(registry.detect(['other']), None)
+        self.assertTrue(registry._entry_points_loaded)
+
+        params = generic.generic_yaml()
+        params['custom'] = {'fake_token': 'token1'}
+        self.write('parameters.yaml', yaml.dump(params))
+        ip = self.provider()
+        ip.cloud_plugins = registry
+        self.assertTrue(isinstance(ip.cloud, DigitaloceanPlugin))
+
+    @mock.patch('sys.stdout')
+    def test_discover_manifest(self, stdout):
+        TerraformInfraProvider().command(['provider', 'discover'])
+        discovered = stdout.write.call_args_list[0][0][0]
+        self.assertEqual(TerraformInfraProvider.manifest(), discovered)
+
+        manifest = yaml.safe_load(ExtraProvider.manifest())
+        self.assertEqual(
+            manifest['commands']['extra']['parameterFile'],
+            'parameters.yaml',
+        )
+        self.assertTrue('extra' in ExtraProvider().commands)
+        self.assertFalse('extra' in TerraformInfraProvider().commands)
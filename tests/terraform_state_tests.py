@@ -0,0 +1,101 @@
+import unittest
+import tempfile
+import shutil
+import json
+import collections
+import os
+from slingpy.terraform_state import TerraformState
+
+
+def ordered(*items):
+    # terraform writes keys in a fixed order, starting with the version
+    return collections.OrderedDict(items)
+
+
+def state_v3():
+    return ordered(
+        ("version", 3),
+        ("terraform_version", "0.7.2"),
+        ("serial", 12),
+        ("lineage", "0f5a5a8e"),
+        ("modules", [
+            ordered(
+                ("path", ["root"]),
+                ("outputs", {
+                    "master_asg": {
+                        "sensitive": False,
+                        "type": "string",
+                        "value": "master-asg1"
+                    },
+                    "worker_ips": {
+                        "sensitive": False,
+                        "type": "list",
+                        "value": ["10.0.0.1", "10.0.0.2"]
+                    }
+                }),
+                ("resources", {
+                    "aws_instance.bastion": {
+                        "type": "aws_instance",
+                        "primary": {
+                            "id": "i-1",
+                            "attributes": {"user_data": '{"outputs": {}'}
+                        }
+                    }
+                }),
+            )
+        ]),
+    )
+
+
+class TestTerraformState(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'terraform.tfstate')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        with open(self.path, 'w') as stream:
+            stream.write(content)
+
+    def test_outputs_v3(self):
+        self.write(json.dumps(state_v3(), indent=4))
+        state = TerraformState(self.path)
+        self.assertEqual(state.serial(), 12)
+        outputs = state.outputs()
+        self.assertEqual(outputs['master_asg']['value'], 'master-asg1')
+        self.assertEqual(
+            outputs['worker_ips']['value'],
+            ['10.0.0.1', '10.0.0.2'],
+        )
+
+    def test_outputs_v4(self):
+        self.write(json.dumps(ordered(
+            ("version", 4),
+            ("serial", 3),
+            ("outputs", {
+                "master_asg": {"value": "master-asg1", "type": "string"},
+            }),
+            ("resources", []),
+        )))
+        outputs = TerraformState(self.path).outputs()
+        self.assertEqual(outputs['master_asg'], {
+            'sensitive': False,
+            'type': 'string',
+            'value': 'master-asg1',
+        })
+
+    def test_outputs_unknown_format(self):
+        self.write(json.dumps(ordered(
+            ("version", 1),
+            ("serial", 1),
+            ("modules", []),
+        )))
+        self.assertEqual(TerraformState(self.path).outputs(), None)
+        self.write('')
+        self.assertEqual(TerraformState(self.path).outputs(), None)
+        os.remove(self.path)
+        self.assertEqual(TerraformState(self.path).outputs(), None)
+        self.assertEqual(TerraformState(self.path).serial(), None)
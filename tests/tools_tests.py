@@ -0,0 +1,186 @@
+import unittest
+import threading
+import time
+from slingpy.tools import Cache, caches, invalidate
+from slingpy.tools import memoized, memoized_property
+from slingpy.tools import Overlay, TaskGraph, ordered_imap, ordered_map
+
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+
+    @memoized_property
+    def value(self):
+        self.calls += 1
+        return self.calls
+
+    @memoized(maxsize=2)
+    def double(self, i):
+        self.calls += 1
+        return i * 2
+
+
+class Base(object):
+    def __init__(self):
+        self.calls = 0
+
+    @memoized
+    def variables(self):
+        self.calls += 1
+        return {'a': 1}
+
+
+class Override(Base):
+    def variables(self):
+        output = dict(super(Override, self).variables())
+        output['extra'] = 2
+        return output
+
+
+class TestTools(unittest.TestCase):
+
+    def test_ordered_map(self):
+        def slow(i):
+            time.sleep(0.01 * (5 - i))
+            return i * 2
+
+        self.assertEqual(ordered_map(slow, range(5)), [0, 2, 4, 6, 8])
+        self.assertEqual(
+            ordered_map(slow, range(5), workers=5),
+            [0, 2, 4, 6, 8],
+        )
+        self.assertEqual(ordered_map(slow, [], workers=5), [])
+
+    def test_ordered_imap_lazy(self):
+        consumed = []
+
+        def items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        results = ordered_imap(lambda i: i + 1, items(), workers=2)
+        self.assertEqual(next(results), 1)
+        self.assertTrue(len(consumed) <= 3)
+        self.assertEqual(list(results), range(2, 11))
+
+    def test_cache_lru(self):
+        cache = Cache(maxsize=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: None)
+        cache.get('c', lambda: 3)
+        self.assertEqual(cache.get('a', lambda: None), 1)
+        self.assertEqual(cache.get('b', lambda: 4), 4)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4, 'size': 2})
+
+    def test_cache_ttl(self):
+        cache = Cache(ttl=0.01)
+        cache.get('a', lambda: 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a', lambda: 2), 2)
+        cache.invalidate('a')
+        self.assertEqual(len(cache), 0)
+
+    def test_memoized_per_instance(self):
+        a = Counter()
+        b = Counter()
+        self.assertEqual(a.value, 1)
+        self.assertEqual(a.value, 1)
+        self.assertEqual(b.value, 1)
+        self.assertEqual(caches(a)['value'].stats()['hits'], 1)
+        invalidate(a, 'value')
+        self.assertEqual(a.value, 2)
+        with self.assertRaises(AttributeError):
+            a.value = 3
+
+    def test_memoized_method(self):
+        a = Counter()
+        self.assertEqual(a.double(2), 4)
+        self.assertEqual(a.double(2), 4)
+        self.assertEqual(a.calls, 1)
+        a.double.invalidate()
+        self.assertEqual(a.double(2), 4)
+        self.assertEqual(a.calls, 2)
+        self.assertEqual(a.double([1]), [1, 1])
+
+    def test_overlay(self):
+        base = {'a': {'b': 1, 'c': [1]}, 'd': 2}
+        overlay = Overlay(base)
+        overlay['a']['b'] = 3
+        overlay['a']['c'].append(2)
+        overlay['e'] = 4
+        del overlay['d']
+
+        self.assertEqual(base, {'a': {'b': 1, 'c': [1]}, 'd': 2})
+        self.assertEqual(overlay, {'a': {'b': 3, 'c': [1, 2]}, 'e': 4})
+        self.assertEqual(
+            overlay.merged(),
+            {'a': {'b': 3, 'c': [1, 2]}, 'e': 4},
+        )
+        self.assertEqual(list(overlay), ['a', 'e'])
+        self.assertEqual(len(overlay), 2)
+        self.assertFalse('d' in overlay)
+        with self.assertRaises(KeyError):
+            overlay['d']
+        overlay['d'] = 5
+        self.assertEqual(overlay['d'], 5)
+        self.assertEqual(base['d'], 2)
+
+    def task_graph(self, workers, calls):
+        def task(name, fail=None):
+            def run():
+                calls.append(name)
+                if fail is not None:
+                    raise fail
+                return name
+            return run
+
+        graph = TaskGraph(workers=workers)
+        graph.add('a', task('a'))
+        graph.add('b', task('b'))
+        graph.add('c', task('c'), after=['a', 'b'])
+        graph.add('d', task('d'))
+        return graph, task
+
+    def test_task_graph_serial(self):
+        calls = []
+        graph, _ = self.task_graph(1, calls)
+        self.assertEqual(
+            graph.run(),
+            {'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd'},
+        )
+        self.assertEqual(calls, ['a', 'b', 'c', 'd'])
+        with self.assertRaises(ValueError):
+            graph.add('e', lambda: None, after=['f'])
+
+    def test_task_graph_concurrent(self):
+        calls = []
+        graph, _ = self.task_graph(4, calls)
+        barrier = threading.Event()
+        # e only finishes in time if f runs concurrently
+        graph.add('e', lambda: barrier.wait(5))
+        graph.add('f', barrier.set)
+        results = graph.run()
+        self.assertTrue(results['e'])
+        self.assertEqual(results['c'], 'c')
+        self.assertTrue(calls.index('c') > calls.index('a'))
+        self.assertTrue(calls.index('c') > calls.index('b'))
+
+    def test_task_graph_errors(self):
+        for workers in [1, 4]:
+            calls = []
+            graph, task = self.task_graph(workers, calls)
+            graph.add('e', task('e', SystemExit(1)), after=['c'])
+            graph.add('f', task('f', ValueError()), after=['c'])
+            graph.add('g', task('g'), after=['e'])
+            with self.assertRaises(SystemExit):
+                graph.run()
+            self.assertFalse('g' in calls)
+
+    def test_memoized_override(self):
+        o = Override()
+        self.assertEqual(o.variables(), {'a': 1, 'extra': 2})
+        self.assertEqual(o.variables(), {'a': 1, 'extra': 2})
+        self.assertEqual(o.calls, 1)
@@ -0,0 +1,76 @@
+import unittest
+import mock
+import logging
+import tempfile
+import shutil
+import json
+import os
+from slingpy import TerraformInfraProvider, tracing
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        if os.environ.get('DEBUG') is None:
+            logging.disable(logging.CRITICAL)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        tracing.disable()
+        shutil.rmtree(self.dir)
+
+    def test_disabled(self):
+        with tracing.span('a') as span:
+            tracing.count('b')
+        self.assertFalse(tracing.tracer.enabled)
+        self.assertIs(span, tracing.span('c'))
+
+    def test_spans(self):
+        tracer = tracing.enable()
+        with tracing.span('outer'):
+            with tracing.span('inner', key='value'):
+                tracing.count('calls', 2)
+            with tracing.span('inner'):
+                pass
+        tracing.add('hook', tracer.started, 0.5)
+
+        self.assertEqual(
+            [(s.name, s.depth) for s in tracer.spans],
+            [('inner', 1), ('inner', 1), ('outer', 0), ('hook', 0)],
+        )
+        self.assertEqual(tracer.spans[0].args, {'key': 'value'})
+        self.assertEqual(tracer.counts['calls'], 2)
+        summary = dict((s[0], s[1]) for s in tracer.summary())
+        self.assertEqual(summary, {'outer': 1, 'inner': 2, 'hook': 1})
+
+        path = os.path.join(self.dir, 'trace.json')
+        tracer.write(path, chrome=True)
+        with open(path) as stream:
+            events = json.load(stream)['traceEvents']
+        self.assertEqual(events[0]['ph'], 'X')
+        self.assertEqual(events[-1]['name'], 'calls')
+
+    @mock.patch('sys.stdout')
+    def test_command_trace(self, stdout):
+        path = os.path.join(self.dir, 'trace.json')
+        TerraformInfraProvider().command([
+            'provider',
+            'discover',
+            '--trace=%s' % path,
+        ])
+        self.assertFalse(tracing.tracer.enabled)
+        with open(path) as stream:
+            spans = json.load(stream)['spans']
+        self.assertEqual(
+            [span['name'] for span in spans],
+            ['yaml dump', 'command discover'],
+        )
+
+        workdir = os.path.join(self.dir, 'c1')
+        os.mkdir(workdir)
+        TerraformInfraProvider(workdir=workdir).command([
+            'provider',
+            'discover',
+            '--trace',
+        ])
+        self.assertTrue(os.path.exists(os.path.join(workdir, 'trace.json')))